@@ -0,0 +1,12 @@
+#!/bin/bash
+
+APP_NAME=${1}
+SOURCE_NAME=${2}
+shift 2
+
+TARGETS=()
+for DESTINATION_NAME in "$@"; do
+    TARGETS+=(-T calibration_${DESTINATION_NAME}.events,profile_${DESTINATION_NAME}.json,${APP_NAME}_${SOURCE_NAME}_to_${DESTINATION_NAME}.reran)
+done
+
+./mosaic.py -a batch-translate -i ${APP_NAME}_${SOURCE_NAME}.virtual "${TARGETS[@]}"
@@ -2,5 +2,6 @@
 
 DEVICE_NAME=${1}
 
+./mosaic.py -a profile > profile_${DEVICE_NAME}.json
 echo "Press Ctrl+C to stop recording"
 ./mosaic.py -a record > calibration_${DEVICE_NAME}.events
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+APP_NAME=${1}
+SOURCE_NAME=${2}
+DESTINATION_NAME=${3}
+
+RERAN_TRACE=${APP_NAME}_${SOURCE_NAME}_to_${DESTINATION_NAME}.reran
+
+./mosaic.py -a fleet-replay -i ${RERAN_TRACE}
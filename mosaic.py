@@ -2,10 +2,44 @@
 
 import subprocess
 import sys
+import os
 import re
+import stat
+import mmap
+import struct
+import json
+import time
+import copy
+import multiprocessing
+import threading
+import hashlib
+import signal
+import Queue
+import random
+import shutil
+import tempfile
+import platform
+import bisect
+import atexit
+import contextlib
+import resource
+import fcntl
 from enum import IntEnum
 import itertools
-import argparse
+import collections
+import operator
+
+# Part of every artifact cache key; bump it when the output of virtualize or
+# translate changes.
+__version__ = '1.2'
+
+# NumPy is imported on first use of the numpy backend (see load_numpy()).
+np = None
+
+
+class MosaicError(Exception):
+    """ Raised by the library functions instead of exiting; the command line
+    prints the message and exits with status 1. """
 
 
 # Derived from input.h in Linux kernel
@@ -95,57 +129,240 @@ class Event(object):
         self.ev_value = ev_value
 
     def __eq__(self, other):
-        if self.ev_type == other.ev_code and self.ev_value == other.ev_value:
-            if (self.ev_type == Input.Type.KEY and self.ev_code == Input.KEY.BTN_TOUCH):
-#or (self.ev_type == Input.Type.ABS and self.ev_type == Input.ABS.MT_TRACKING_ID):
-                return self.ev_value == other.ev_value
-            else:
-                return True
-        else:
-            return False
+        return (self.ev_type, self.ev_code, self.ev_value) == \
+               (other.ev_type, other.ev_code, other.ev_value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.ev_type, self.ev_code, self.ev_value))
 
     def __str__(self):
         return "%d,%d,%d,%s" % (self.ev_time, self.ev_type, self.ev_code, self.ev_value)
 
 
+TRACKING_ID_NONE = int('0xffffffff', 16)
+MAX_POINTERS = 10
+
+
+# Virtual trace actions
+ACTIONS = ('move', 'press', 'release')
+MOVE, PRESS, RELEASE = range(len(ACTIONS))
+
+
 def shell(args):
     """ TODO """
     shell = subprocess.Popen(args, stdout=subprocess.PIPE,
                            stderr=subprocess.PIPE)
     stdout, stderr = shell.communicate()
     if shell.returncode != 0:
-        print >> sys.stderr, stderr
-        sys.exit(1)
+        raise MosaicError(stderr.strip() or '%s exited with status %d.'
+                          % (args[0], shell.returncode))
     return ( line for line in stdout.split('\r\n') )
 
 
 def adb_devices():
-    """ TODO """
-    adb_args = ['adb', 'devices']
-    return [ serial_num for idx, serial_num in 
-            enumerate(' '.join(shell(adb_args)).split()) 
-            if idx > 3 and idx % 2 == 0 ]
-    
+    """ Lists the serial numbers of the devices reachable through the
+    selected transport. """
+    return TRANSPORT_TYPES[TRANSPORT].devices()
+
 
 def adb_shell(serial_num, cmd):
-    """ TODO """
-    adb_args = ['adb', '-s', serial_num, 'shell'] + cmd.split()
-    stdout = shell(adb_args)
-    return ( line for line in stdout )
+    """ Runs a shell command on a device through its transport (see
+    get_transport()) and returns a generator over its output lines. """
+    return get_transport(serial_num).run(cmd)
 
 def adb_push(serial_num, filename):
     """ TODO """
-    adb_args = ['adb', '-s', serial_num, 'push', filename, '/sdcard/' ]
-    stdout = shell(adb_args)
-    return ( line for line in stdout )
+    return get_transport(serial_num).push(filename, '/sdcard/')
+
+
+# Device transports. adb_shell() and adb_push() go through one transport per
+# device, selected with --transport:
+#   spawn       one adb process per command, as before (the default);
+#   persistent  one long-lived 'adb shell' per device; every command is
+#               followed by an echo of a random sentinel and its exit status,
+#               which marks the end of its output. The sentinel is split in
+#               two in the command line, so a shell that echoes its input
+#               never prints it;
+#   local       the persistent protocol over a local sh, with pushes copied
+#               into a local directory, to run the pipeline without a device.
+# Long-running commands (getevent streams, the sendevent shell of mirror,
+# fleet-replay's commands) get a process of their own from stream().
+
+TRANSPORT = 'spawn'
+TRANSPORTS = {}
+TRANSPORTS_LOCK = threading.Lock()
+LOCAL_ROOT = '.'
+LOCAL_SERIAL = 'local'
+
+
+def command_failed(cmd, status, output):
+    raise MosaicError('\n'.join(output) if output else
+                      '%s exited with status %d.' % (cmd, status))
+
+
+class SpawnTransport(object):
+
+    def __init__(self, serial_num):
+        self.serial_num = serial_num
+
+    @staticmethod
+    def devices():
+        return [ serial_num for idx, serial_num in
+                 enumerate(' '.join(shell(['adb', 'devices'])).split())
+                 if idx > 3 and idx % 2 == 0 ]
+
+    def shell_args(self, cmd=None):
+        return [ 'adb', '-s', self.serial_num, 'shell' ] + (cmd.split() if cmd else [])
+
+    def stream(self, cmd=None, stdin=None, stdout=subprocess.PIPE):
+        """ Starts cmd (an interactive shell when None) in a process of its
+        own and returns the Popen object. """
+        return subprocess.Popen(self.shell_args(cmd), stdin=stdin, stdout=stdout,
+                                stderr=subprocess.PIPE if stdout == subprocess.PIPE
+                                else subprocess.STDOUT)
+
+    def call(self, cmd):
+        """ Runs cmd to completion; returns (status, stdout, stderr). """
+        process = self.stream(cmd)
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr
+
+    def run(self, cmd):
+        return self.read(self.stream(cmd), cmd)
+
+    def read(self, adb, cmd):
+        for line in iter(adb.stdout.readline, ''):
+            yield line.rstrip('\r\n')
+        stderr = adb.stderr.read()
+        if adb.wait() != 0:
+            command_failed(cmd, adb.returncode, stderr.splitlines())
+
+    def push(self, filename, remote_dir):
+        return shell(['adb', '-s', self.serial_num, 'push', filename, remote_dir])
+
+    def close(self):
+        pass
+
+
+class ShellTransport(SpawnTransport):
+    """ Runs commands over one long-lived shell process, streaming the output
+    of each command until its sentinel line. A command whose output was not
+    read to the end is drained before the next one is sent. """
+
+    def __init__(self, serial_num):
+        SpawnTransport.__init__(self, serial_num)
+        self.process = subprocess.Popen(self.shell_args(),
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def run(self, cmd):
+        with self.lock:
+            if self.pending is not None:
+                for line in self.read(*self.pending):
+                    pass
+            token = '%016x' % random.getrandbits(64)
+            command = '%s </dev/null 2>&1; echo "__mosaic_""%s__ $?"' % (cmd, token)
+            self.process.stdin.write(command + '\n')
+            self.process.stdin.flush()
+            sentinel = re.compile(r'^(.*)__mosaic_%s__ ([0-9]+)$' % token)
+            self.pending = (sentinel, cmd, command)
+        return self.read(sentinel, cmd, command)
+
+    def read(self, sentinel, cmd, command):
+        """ Yields output lines up to the sentinel line. Output that does not
+        end with a newline precedes the sentinel on its line; the command line
+        itself is skipped when the shell echoes it. """
+        output = []
+        echoed = False
+        for line in iter(self.process.stdout.readline, ''):
+            line = line.rstrip('\r\n')
+            if not echoed and not output and line == command:
+                echoed = True
+                continue
+            r = sentinel.match(line)
+            if r is not None:
+                head, status = r.groups()
+                if head:
+                    yield head
+                break
+            output = output[-20:] + [ line ]
+            yield line
+        else:
+            raise MosaicError('the shell of %s exited.' % self.serial_num)
+        if self.pending is not None and self.pending[0] == sentinel:
+            self.pending = None
+        if int(status) != 0:
+            command_failed(cmd, int(status), output)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+
+
+class LocalTransport(ShellTransport):
+    """ ShellTransport over a local sh; files are pushed into LOCAL_ROOT.
+    The only device is LOCAL_SERIAL. """
+
+    @staticmethod
+    def devices():
+        return [ LOCAL_SERIAL ]
+
+    def shell_args(self, cmd=None):
+        return [ 'sh' ] + ([ '-c', cmd ] if cmd else [])
+
+    def push(self, filename, remote_dir):
+        directory = os.path.join(LOCAL_ROOT, remote_dir.strip('/'))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copy(filename, directory)
+        return [ '%s -> %s' % (filename, directory) ]
+
+
+TRANSPORT_TYPES = { 'spawn': SpawnTransport,
+                    'persistent': ShellTransport,
+                    'local': LocalTransport }
+
+
+def get_transport(serial_num):
+    """ Returns the transport of a device, starting it on first use. """
+    with TRANSPORTS_LOCK:
+        transport = TRANSPORTS.get(serial_num)
+        if transport is None:
+            if not TRANSPORTS:
+                atexit.register(close_transports)
+            transport = TRANSPORTS[serial_num] = TRANSPORT_TYPES[TRANSPORT](serial_num)
+    return transport
+
+
+def close_transports():
+    for transport in TRANSPORTS.values():
+        transport.close()
+    TRANSPORTS.clear()
+
+
+DISPLAY_RE = re.compile(r'.*init=([0-9]+)x([0-9]+).*cur=([0-9]+)x([0-9]+)'
+                        r'.*app=([0-9]+)x([0-9]+).*', re.M | re.I)
+MAX_RE = re.compile(r'.*max ([0-9]+).*', re.M | re.I)
+ADD_DEVICE_RE = re.compile(r'add device.*: (.*)', re.M | re.I)
+HEADER_RE = re.compile(r'#\s*([A-Za-z ]+):\s*(.*)')
+SCREEN_RE = re.compile(r'([0-9]+)x([0-9]+) (\w+)')
+ORIENTATION_RE = re.compile(r'#\s*Orientation:\s*(\w+)')
 
 
 def get_display_info(output, device):
 #    output = adb("dumpsys window").split("\r\n")
     for line in output:
         if 'init' in line and 'cur' in line and 'app' in line:
-            r = re.match(r'.*init=([0-9]+)x([0-9]+).*cur=([0-9]+)x([0-9]+)'
-                         r'.*app=([0-9]+)x([0-9]+).*', line, re.M | re.I)
+            r = DISPLAY_RE.match(line)
             device.init_display = Screen(r.group(1), r.group(2))
             device.cur_display = Screen(r.group(3), r.group(4))
             device.app_display = Screen(r.group(5), r.group(6))
@@ -156,10 +373,10 @@ def get_touchscreen_info(output, device):
 #    output = adb("getevent -lp").split("\r\n")
     for line in output:
         if 'ABS_MT_POSITION_X' in line or 'ABS_X' in line:
-            r = re.match(r'.*max ([0-9]+).*', line, re.M | re.I)
+            r = MAX_RE.match(line)
             touchscreen_width = r.group(1)
         if 'ABS_MT_POSITION_Y' in line or 'ABS_Y' in line:
-            r = re.match(r'.*max ([0-9]+).*', line, re.M | re.I)
+            r = MAX_RE.match(line)
             touchscreen_height = r.group(1)
     device.init_touchscreen = Screen(touchscreen_width, touchscreen_height)
     device.cur_touchscreen = Screen()
@@ -177,16 +394,216 @@ def get_touchscreen_info(output, device):
     device.menu_touchscreen.ymax = device.cur_touchscreen.ymax - device.app_touchscreen.ymax
 
 
+DEVICE_HEADER = (('Default Display', 'init_display'),
+                 ('Current Display', 'cur_display'),
+                 ('App Display', 'app_display'),
+                 ('Rotated', 'rotated'),
+                 ('Default Touchscreen', 'init_touchscreen'),
+                 ('Current Touchscreen', 'cur_touchscreen'),
+                 ('App Touchscreen', 'app_touchscreen'),
+                 ('Menu Touchscreen', 'menu_touchscreen'))
+SCREENS = [ attr for label, attr in DEVICE_HEADER if attr != 'rotated' ]
+
+
+def device_header(device):
+    """ Yields the '#' comment lines describing the device geometry. """
+    for label, attr in DEVICE_HEADER:
+        yield "# %s: %s" % (label, str(getattr(device, attr)))
+
+
+def make_screen(xmax, ymax, orientation):
+    screen = Screen()
+    screen.xmax = int(xmax)
+    screen.ymax = int(ymax)
+    screen.orientation = orientation
+    return screen
+
+
+def parse_device_header(comment_lines, serial_num=None):
+    """ Rebuilds a Device from device_header() lines, or None if absent. """
+    attrs = dict(DEVICE_HEADER)
+    device = Device(serial_num)
+    found = False
+    for line in comment_lines:
+        r = HEADER_RE.match(line.strip())
+        if r is None or r.group(1) not in attrs:
+            continue
+        found = True
+        if r.group(1) == 'Rotated':
+            device.rotated = r.group(2) == 'True'
+        else:
+            s = SCREEN_RE.match(r.group(2))
+            setattr(device, attrs[r.group(1)], make_screen(s.group(1), s.group(2), s.group(3)))
+    return device if found else None
+
+
 def get_touch_device(output):
     for line in output:
         if 'add' in line:
-            r = re.match(r'add device.*: (.*)', line, re.M | re.I)
+            r = ADD_DEVICE_RE.match(line)
             device = r.group(1)
         elif '0039  :' in line:
             break
     return device
 
 
+# Device profiles. The touch device node and the display/touchscreen
+# geometry are cached on disk per serial number so that repeated
+# invocations skip the adb queries, and virtualize/translate can run
+# without the device attached.
+
+PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.mosaic', 'profiles')
+PROFILE_TTL = 24 * 60 * 60
+
+
+def query_device(serial_num):
+    """ Queries the touch device node and geometry of an attached device. """
+    touchscreen_device = get_touch_device(adb_shell(serial_num, 'getevent -p'))
+    device = Device(serial_num)
+    get_display_info(adb_shell(serial_num, "dumpsys window"), device)
+    get_touchscreen_info(adb_shell(serial_num, "getevent -lp"), device)
+    return device, touchscreen_device
+
+
+def device_profile(device, touchscreen_device):
+    profile = { 'serial_num': device.serial_num,
+                'touch_device': touchscreen_device,
+                'rotated': device.rotated,
+                'created': time.time() }
+    for attr in SCREENS:
+        screen = getattr(device, attr)
+        profile[attr] = [ screen.xmax, screen.ymax, screen.orientation ]
+    return profile
+
+
+def profile_device(profile):
+    """ Rebuilds the (Device, touch device node) pair stored in a profile. """
+    device = Device(profile['serial_num'])
+    device.rotated = profile['rotated']
+    for attr in SCREENS:
+        setattr(device, attr, make_screen(*profile[attr]))
+    return device, str(profile['touch_device'])
+
+
+def is_device_profile(profile):
+    return isinstance(profile, dict) and all( key in profile for key in
+                                              [ 'serial_num', 'touch_device', 'rotated' ] + SCREENS )
+
+
+def profile_path(serial_num, profile_dir=PROFILE_DIR):
+    return os.path.join(profile_dir, serial_num + '.json')
+
+
+def load_json(path):
+    """ Returns the parsed contents of a JSON file, or None when it cannot be
+    read or parsed. """
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return None
+
+
+def make_dirs(directory):
+    """ os.makedirs() that tolerates the directory appearing concurrently. """
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def save_json(data, path):
+    """ Writes JSON through a private temporary file and a rename, so
+    concurrent writers never see or clobber a partial file. """
+    directory = os.path.dirname(path)
+    make_dirs(directory)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'w') as json_file:
+            json.dump(data, json_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def cached_serial_nums(profile_dir=PROFILE_DIR):
+    if not os.path.isdir(profile_dir):
+        return []
+    return sorted( name[:-len('.json')] for name in os.listdir(profile_dir)
+                   if name.endswith('.json') )
+
+
+def geometry_changed(profile, serial_num):
+    """ Re-reads the display configuration and compares it with the profile. """
+    current = Device(serial_num)
+    get_display_info(adb_shell(serial_num, "dumpsys window"), current)
+    cached, _ = profile_device(profile)
+    for attr in ('init_display', 'cur_display', 'app_display'):
+        if (getattr(current, attr).xmax, getattr(current, attr).ymax) != \
+           (getattr(cached, attr).xmax, getattr(cached, attr).ymax):
+            return True
+    return current.rotated != cached.rotated
+
+
+def get_device(args):
+    """ Returns (Device, touch device node), from the profile cache when
+    possible and from the attached device otherwise. """
+    if args.profile_file is not None:
+        profile = load_json(args.profile_file)
+        if not is_device_profile(profile):
+            raise MosaicError('cannot read device profile %s.' % args.profile_file)
+        return profile_device(profile)
+
+    if args.offline and args.target_serial_num is None:
+        serial_nums = cached_serial_nums(args.profile_dir)
+        if len(serial_nums) != 1:
+            raise MosaicError('specify the device serial number (-t) '
+                              'to select a cached profile.')
+        serial_num = serial_nums[0]
+    else:
+        serial_num = get_serial_num(args)
+
+    path = profile_path(serial_num, args.profile_dir)
+    profile = None if args.refresh_profile else load_json(path)
+    if not is_device_profile(profile):
+        profile = None
+    if args.offline:
+        if profile is None:
+            raise MosaicError('no cached profile for device %s.' % serial_num)
+        return profile_device(profile)
+
+    if profile is not None and time.time() - profile['created'] > args.profile_ttl:
+        profile = None
+    if profile is not None and args.profile_check and geometry_changed(profile, serial_num):
+        profile = None
+    if profile is None:
+        profile = device_profile(*query_device(serial_num))
+        save_json(profile, path)
+    return profile_device(profile)
+
+
+def show_profile(args):
+    """ Caches (refreshing if requested) and prints a device profile. """
+    device, touchscreen_device = get_device(args)
+    print json.dumps(device_profile(device, touchscreen_device), indent=2, sort_keys=True)
+
+
+def invalidate_profile(args):
+    """ Removes the cached profile of one device, or of all devices. """
+    if args.target_serial_num is not None:
+        serial_nums = [ args.target_serial_num ]
+    else:
+        serial_nums = cached_serial_nums(args.profile_dir)
+    for serial_num in serial_nums:
+        path = profile_path(serial_num, args.profile_dir)
+        if os.path.exists(path):
+            os.remove(path)
+
+
 def line_is_event(line):
     return '/dev/input/event' in line and 'add' not in line
 #    return line.find('/dev/input/event') != -1 and line.find('[') != -1
@@ -218,8 +635,14 @@ def extract_value(raw_value):
     return int(raw_value, 16)
 
 
+def signed_value(value):
+    """ Reads a raw 32-bit event value (e.g. a lifted tracking id, 0xffffffff)
+    as the signed integer that sendevent expects. """
+    return value - (1 << 32) if value >= 1 << 31 else value
+
+
 def valid(touchscreen_device, input_event_line):
-    not_touchscreen_registration = "add" not in input_event_line
+    not_touchscreen_registration = "add device" not in input_event_line
     is_touchscreen_input_event = touchscreen_device + ':' in input_event_line
     return not_touchscreen_registration and is_touchscreen_input_event
 
@@ -238,175 +661,2372 @@ def classify(event):
     elif Input.Type(event.ev_type) is Input.Type.ABS:
         return (Input.Type.ABS, Input.ABS(event.ev_code))
 
-def encode(event):
-    return (classify(event)[0], classify(event)[1] , event.ev_value if classify(event) == (Input.Type.KEY, Input.KEY.BTN_TOUCH) or 
-            (classify(event)[1] == Input.ABS.MT_TRACKING_ID and event.ev_value == int('0xffffffff',16)) 
-            else 0 )
+def signature(ev_type, ev_code, ev_value):
+    """ Returns the (type, code, value class) key of an event: the value is
+    kept for BTN_TOUCH and for a released tracking id, and is 0 otherwise. """
+    if (ev_type == Input.Type.KEY and ev_code == Input.KEY.BTN_TOUCH) or \
+       (ev_type == Input.Type.ABS and ev_code == Input.ABS.MT_TRACKING_ID and
+        ev_value == TRACKING_ID_NONE):
+        return (ev_type, ev_code, ev_value)
+    return (ev_type, ev_code, 0)
 
-def get_interactions(input_event_file):
-    """ TODO """
-    event_stream = filter(lambda input_event_line: '#' not in input_event_line, input_event_file)
-    touchscreen_events = map(lambda input_event_line: parse_device(input_event_line), event_stream)
-    splits = [ -1 ] + [ idx for idx, event in enumerate(touchscreen_events) 
-                       if event.ev_type == Input.Type.SYN and event.ev_code == Input.Type.SYN ]
-    touchscreen_interactions = [ touchscreen_events[splits[i]+1:splits[i+1]+1] 
-                                for i in range(0,len(splits)-1) ]
-    return touchscreen_interactions
 
+def encode(event):
+    return signature(event.ev_type, event.ev_code, event.ev_value)
 
-def get_ref_interactions(event_stream):
-    """ TODO """
+def open_input(filename):
+    """ Opens a trace for reading; '-' (or no name) reads from stdin. """
+    if filename is None or filename == '-':
+        return sys.stdin
+    return open(filename, 'r')
 
-    touchscreen_interactions = get_interactions(event_stream)
 
-    press = touchscreen_interactions[0]
-    moves = [ event for interaction in touchscreen_interactions[1:-1] for event in interaction ]
-    release = touchscreen_interactions[-1]
-    return press, moves, release
+def iter_lines(input_file):
+    """ Iterates over lines; stdin is read line by line, bypassing the
+    read-ahead buffer of file iteration, so piped input is consumed as
+    soon as it arrives. """
+    if input_file is sys.stdin:
+        return iter(input_file.readline, '')
+    return input_file
 
 
-def virtualize(args):
-    """ TODO """
-    serial_num = get_serial_num(args)
-    touchscreen_device = get_touch_device(adb_shell(serial_num, 'getevent -p'))
+def iter_events(input_event_lines):
+    """ Lazily parses recorded lines into events, skipping comments. """
+    for input_event_line in input_event_lines:
+        if '#' in input_event_line or not input_event_line.strip():
+            continue
+        yield parse_device(input_event_line)
 
-    device = Device(serial_num)
-    get_display_info(adb_shell(serial_num, "dumpsys window"), device)
-    get_touchscreen_info(adb_shell(serial_num, "getevent -lp"), device)
-    
-    # ref_press, ref_moves, ref_release = get_ref_interactions(open(serial_num + '.one_finger_swipe'))
-    ref_press, ref_moves, ref_release = get_ref_interactions(open(args.calibration_file))
-    ref_press_encoded = map(lambda event: encode(event), ref_press) 
-    ref_moves_encoded = map(lambda event: encode(event), ref_moves) 
-    ref_release_encoded = map(lambda event: encode(event), ref_release) 
-
-    #print [ str(event) for event in ref_press_encoded ]
-    #print [ str(event) for event in ref_moves ]
-    #print [ str(event) for event in ref_release_encoded ]
 
-    uniq_press = set(ref_press_encoded) - set(ref_moves_encoded) - set(ref_release_encoded)
-    uniq_release = set(ref_release_encoded) - set(ref_moves_encoded) - set(ref_press_encoded)
-
-#    print [ str(event) for event in uniq_press ]
-#    print [ str(event) for event in uniq_release ]
+def iter_interactions(touchscreen_events):
+    """ Groups events into interactions at each SYN_REPORT boundary.
+    Only one interaction is held in memory at a time; trailing events
+    without a closing SYN_REPORT are dropped. """
+    interaction = []
+    for event in touchscreen_events:
+        interaction.append(event)
+        if event.ev_type == Input.Type.SYN and event.ev_code == Input.SYN.REPORT:
+            yield interaction
+            interaction = []
+
+
+class SignatureClassifier(object):
+    """ Labels interactions from the calibration signatures. Every signature
+    unique to the press or to the release owns one bit of a lookup table, so
+    an interaction is classified by OR-ing the bits of its events: it is a
+    press (release) when more than three quarters of the press (release)
+    bits are set. """
+
+    def __init__(self, uniq_press, uniq_release):
+        signatures = sorted(uniq_press) + sorted(uniq_release)
+        self.table = dict( (tuple(int(field) for field in key), 1 << bit)
+                           for bit, key in enumerate(signatures) )
+        self.bits = len(signatures)
+        self.press_mask = (1 << len(uniq_press)) - 1
+        self.release_mask = ((1 << len(uniq_release)) - 1) << len(uniq_press)
+        self.press_threshold = 3 * len(uniq_press)
+        self.release_threshold = 3 * len(uniq_release)
+
+    def mask(self, interaction):
+        lookup = self.table.get
+        mask = 0
+        for event in interaction:
+            mask |= lookup(signature(event.ev_type, event.ev_code, event.ev_value), 0)
+        return mask
+
+    def label(self, mask):
+        if 4 * bin(mask & self.press_mask).count('1') > self.press_threshold:
+            return PRESS
+        if 4 * bin(mask & self.release_mask).count('1') > self.release_threshold:
+            return RELEASE
+        return MOVE
+
+
+def get_classifier(event_stream):
+    """ Builds the SignatureClassifier of a calibration recording. """
+    model = CalibrationModel()
+    model.add_events(event_stream)
+    return model.classifier()
+
+
+# Calibration models. A calibration recording holds one or more gestures,
+# each closed by the interaction that lifts the finger (a released tracking
+# id or BTN_TOUCH 0); a recording without lifts is one gesture. For every
+# event signature the model counts the gestures whose press (first
+# interaction), moves and release (last interaction) contain it, and keeps
+# the most common press and release interactions as the references of
+# translation templates. Press (release) signatures are those found in the
+# press (release) of more than half of the gestures and in the rest of at
+# most a quarter of them, so stray touches do not break calibration; for a
+# single swipe they are the signatures found only in its press (release).
+# Adding a recording only walks its own events, so models can be grown
+# recording by recording with the learn action.
+
+CALIBRATION_VERSION = 1
+PRESS_PART, MOVES_PART, RELEASE_PART = range(3)
+
+
+def is_lift(event):
+    return (event.ev_type == Input.Type.ABS and event.ev_code == Input.ABS.MT_TRACKING_ID and
+            event.ev_value == TRACKING_ID_NONE) or \
+           (event.ev_type == Input.Type.KEY and event.ev_code == Input.KEY.BTN_TOUCH and
+            event.ev_value == 0)
+
+
+class CalibrationModel(object):
+
+    def __init__(self):
+        self.gestures = 0
+        self.counts = {}
+        self.shapes = (collections.OrderedDict(), collections.OrderedDict())
+        self.sources = []
+
+    def add_events(self, event_stream, source=None):
+        """ Adds the gestures of a calibration recording; returns False when
+        the recording (identified by source) was already added. """
+        if source is not None:
+            if source in self.sources:
+                return False
+            self.sources.append(source)
+        first = last = None
+        moves = set()
+        lifted = False
+        for interaction in iter_interactions(event_stream):
+            if first is None:
+                first = interaction
+            else:
+                if last is not None:
+                    moves.update(encode(event) for event in last)
+                last = interaction
+            if any( is_lift(event) for event in interaction ):
+                self.add_gesture(first, moves, last)
+                first = last = None
+                moves = set()
+                lifted = True
+        if not lifted:
+            self.add_gesture(first, moves, last)
+        return True
+
+    def add_gesture(self, press, moves, release):
+        """ Counts one gesture; gestures of less than two interactions tell
+        nothing about presses and releases and are skipped. """
+        if press is None or release is None:
+            return
+        self.gestures += 1
+        for part, signatures in ((PRESS_PART, set( encode(event) for event in press )),
+                                 (MOVES_PART, moves),
+                                 (RELEASE_PART, set( encode(event) for event in release ))):
+            for key in signatures:
+                key = tuple( int(field) for field in key )
+                self.counts.setdefault(key, [ 0, 0, 0 ])[part] += 1
+        for shapes, interaction in zip(self.shapes, (press, release)):
+            events = tuple( (int(event.ev_type), int(event.ev_code), int(event.ev_value))
+                            for event in interaction )
+            shape = tuple( signature(*event) for event in events )
+            if shape in shapes:
+                shapes[shape][0] += 1
+            else:
+                shapes[shape] = [ 1, events ]
+
+    def signatures(self):
+        """ Returns the press and release signature sets. """
+        uniq_press, uniq_release = set(), set()
+        for key, (press, moves, release) in self.counts.items():
+            if 2 * press > self.gestures and 4 * moves <= self.gestures and \
+               4 * release <= self.gestures:
+                uniq_press.add(key)
+            if 2 * release > self.gestures and 4 * moves <= self.gestures and \
+               4 * press <= self.gestures:
+                uniq_release.add(key)
+        return uniq_press, uniq_release
+
+    def classifier(self):
+        return SignatureClassifier(*self.signatures())
+
+    def reference(self, action):
+        """ Returns the most common press or release interaction as events;
+        ties go to the one seen first. """
+        shapes = self.shapes[0 if action == PRESS else 1]
+        if not shapes:
+            raise MosaicError('the calibration holds no complete gesture.')
+        count, events = max(shapes.values(), key=lambda shape: shape[0])
+        return [ Event(0, ev_type, ev_code, ev_value) for ev_type, ev_code, ev_value in events ]
+
+    def to_dict(self):
+        return { 'version': CALIBRATION_VERSION,
+                 'gestures': self.gestures,
+                 'signatures': sorted( list(key) + counts for key, counts in self.counts.items() ),
+                 'press': [ [ count, map(list, events) ]
+                            for count, events in self.shapes[0].values() ],
+                 'release': [ [ count, map(list, events) ]
+                              for count, events in self.shapes[1].values() ],
+                 'sources': self.sources }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != CALIBRATION_VERSION:
+            raise MosaicError('unsupported calibration model version %s.' % data.get('version'))
+        model = cls()
+        model.gestures = data['gestures']
+        model.counts = dict( (tuple(entry[:3]), entry[3:]) for entry in data['signatures'] )
+        for shapes, stored in zip(model.shapes, (data['press'], data['release'])):
+            for count, events in stored:
+                events = tuple( tuple(event) for event in events )
+                shapes[tuple( signature(*event) for event in events )] = [ count, events ]
+        model.sources = data['sources']
+        return model
+
+
+def is_calibration_model(path):
+    """ Calibration models are JSON files; calibration traces are not. """
+    with open(path, 'rb') as calibration:
+        return calibration.read(64).lstrip().startswith('{')
+
+
+def load_calibration(calibration_file):
+    """ Returns the CalibrationModel of a model file or of a calibration
+    recording. """
+    try:
+        if is_calibration_model(calibration_file):
+            data = load_json(calibration_file)
+            if data is None:
+                raise MosaicError('cannot read calibration model %s.' % calibration_file)
+            return CalibrationModel.from_dict(data)
+        model = CalibrationModel()
+        model.add_events(read_events(calibration_file))
+    except (IOError, OSError) as error:
+        raise MosaicError('cannot read calibration file %s: %s.'
+                          % (calibration_file, error.strerror or error))
+    return model
+
+
+def learn(args):
+    """ Adds the calibration recording -i to the calibration model -c,
+    creating the model when it does not exist. """
+    if args.calibration_file is None or args.input_file in (None, '-'):
+        raise MosaicError('learn needs a calibration model (-c) and a recording (-i).')
+    model = CalibrationModel()
+    if os.path.exists(args.calibration_file):
+        if not is_calibration_model(args.calibration_file):
+            raise MosaicError('%s is not a calibration model.' % args.calibration_file)
+        model = load_calibration(args.calibration_file)
+    gestures = model.gestures
+    try:
+        with open(args.input_file, 'rb') as recording:
+            source = hashlib.sha1(recording.read()).hexdigest()
+        added = model.add_events(read_events(args.input_file), source)
+    except (IOError, OSError) as error:
+        raise MosaicError('cannot read recording %s: %s.'
+                          % (args.input_file, error.strerror or error))
+    if added:
+        save_json(model.to_dict(), args.calibration_file)
+    uniq_press, uniq_release = model.signatures()
+    print >> sys.stderr, '%d new gestures, %d in total; %d press and %d release signatures.' \
+        % (model.gestures - gestures, model.gestures, len(uniq_press), len(uniq_release))
+
+
+def virtualize_trace(input_file, device, classifier, backend='python'):
+    """ Yields the virtual rows of an opened text or packed .events trace. """
+    if backend == 'numpy':
+        event_arrays = STATS.timed(read_event_arrays(input_file), 'parse', 'events', len)
+        return virtualize_event_arrays(event_arrays, device, classifier)
+    touchscreen_interactions = iter_interactions(STATS.timed(read_events(input_file), 'parse',
+                                                             'events'))
+    return virtualize_interactions(touchscreen_interactions, device, classifier)
+
+
+def virtualize_events(trace, device, classifier, backend='python', multitouch=False):
+    """ Yields the lines of the .virtual trace of a recorded trace (a file
+    name, an open file, a PackedTrace or an iterable of lines), header first. """
+    trace = as_trace(trace)
+    if multitouch:
+        check_multitouch(backend, trace)
+        events = STATS.timed(read_events(trace), 'parse', 'events')
+        pretty_interactions = virtualize_pointers(iter_interactions(events), device)
+    else:
+        pretty_interactions = virtualize_trace(trace, device, classifier, backend)
 
-    input_file = open(args.input_file, 'r')
-    event_stream = filter(lambda line: '#' not in line, input_file.read().splitlines())
+    yield '# Orientation: %s' % device.cur_display.orientation
+    yield '#'
+    yield '# Time Action X Y' + (' Pointer' if multitouch else '')
+    for pretty_interaction in STATS.timed(pretty_interactions, 'virtualize', 'rows'):
+        yield pretty_interaction
 
-    touchscreen_interactions = get_interactions(event_stream)
-    
-    print '# Orientation: %s' % device.cur_display.orientation
-    print '#'
-    print '# Time Action X Y'
 
+def virtualize(args):
+    """ TODO """
+    with STATS.timer('device'):
+        device, touchscreen_device = get_device(args)
+
+    with STATS.timer('cache'):
+        cache, key = artifact_key(args, device, touchscreen_device)
+        if key is not None and cache.fetch(key, sys.stdout):
+            return
+
+    with STATS.timer('calibration'):
+        classifier = load_calibration(args.calibration_file).classifier()
+
+    input_file = open_trace(args.input_file)
+    with STATS.timer('output'), artifact_output(cache, key, sys.stdout) as output:
+        for line in virtualize_events(input_file, device, classifier, args.backend,
+                                      args.multitouch):
+            print >> output, line
+            if input_file is sys.stdin:
+                output.flush()
+
+
+def virtualize_interactions(touchscreen_interactions, device, classifier):
+    """ Yields one tab-separated virtual row per interaction. """
+    classify = STATS.timed_call(classify_interaction, 'classify')
+    position = STATS.timed_call(virtual_position, 'coordinates')
     last_time = None
     for interaction in touchscreen_interactions:
-        interaction_set = set(map(lambda event: encode(event), interaction))
-        if 4 * len(set.intersection(set(interaction_set),uniq_press)) > 3 * len(uniq_press):
-            action = 'press'
-        elif 4 * len(set.intersection(set(interaction_set),uniq_release)) > 3 * len(uniq_release):
-            action = 'release'
-        else:
-            action = 'move'
-        xpos = None
-        ypos = None
-        times = [ event.ev_time for event in interaction ]
-        time = max(times)
+        time, action, x_value, y_value = classify(interaction, classifier)
+        if action == MOVE and x_value is None and y_value is None:
+            continue
+        xpos, ypos = position(device, x_value, y_value)
+        pretty_interaction = [ "%d" % int(time - last_time)  if last_time is not None else str(0) ] 
+        last_time = time
+        pretty_interaction += [ ACTIONS[action] ]
+        pretty_interaction += [ str(xpos) if xpos is not None else '--' ]
+        pretty_interaction += [ str(ypos) if ypos is not None else '--' ]
+        yield '\t'.join(pretty_interaction)
+
+
+def virtualize_interaction(interaction, device, classifier):
+    """ Returns (time, action, x, y) for one interaction, or None for a move
+    without coordinates. """
+    time, action, x_value, y_value = classify_interaction(interaction, classifier)
+    if action == MOVE and x_value is None and y_value is None:
+        return None
+    xpos, ypos = virtual_position(device, x_value, y_value)
+    return time, action, xpos, ypos
+
+
+def classify_interaction(interaction, classifier):
+    """ Returns the time, action and last raw X and Y values (or None) of one
+    interaction. """
+    lookup = classifier.table.get
+    mask = 0
+    time = None
+    x_value = None
+    y_value = None
+    for event in interaction:
+        ev_type, ev_code, ev_value = event.ev_type, event.ev_code, event.ev_value
+        mask |= lookup(signature(ev_type, ev_code, ev_value), 0)
+        if time is None or event.ev_time > time:
+            time = event.ev_time
+        if ev_type == Input.Type.ABS:
+            if ev_code == Input.ABS.MT_POSITION_X or ev_code == Input.ABS.X:
+                x_value = ev_value
+            elif ev_code == Input.ABS.MT_POSITION_Y or ev_code == Input.ABS.Y:
+                y_value = ev_value
+    return time, classifier.label(mask), x_value, y_value
+
+
+def virtualize_pointers(touchscreen_interactions, device):
+    """ Multi-touch counterpart of virtualize_interactions(). Follows the
+    protocol-B slots of the touchscreen and yields one row per pointer (slot)
+    that was pressed, moved or released in an interaction, with the slot as
+    a fifth column. Rows after the first of an interaction have a delta of 0. """
+    slot = 0
+    # Per-slot state: last position, and action/position seen in this interaction.
+    last_x, last_y = [ None ] * MAX_POINTERS, [ None ] * MAX_POINTERS
+    frame_action = [ None ] * MAX_POINTERS
+    frame_x, frame_y = [ None ] * MAX_POINTERS, [ None ] * MAX_POINTERS
+    touched = []
+    last_time = None
+    for interaction in touchscreen_interactions:
+        time = None
         for event in interaction:
-             if classify(event) == (Input.Type.ABS, Input.ABS.MT_POSITION_X) or classify(event) == (Input.Type.ABS, Input.ABS.X):
-                 if not device.rotated:
-                     xpos = ((100.0 * float(event.ev_value)) /
-                            float(device.app_touchscreen.xmax))
-                 else:
-                     ypos = ((100.0 * (float(device.app_touchscreen.ymax) -
-                             float(event.ev_value) +
-                             float(device.menu_touchscreen.ymax))) /
-                             float(device.app_touchscreen.ymax))
-             elif classify(event) == (Input.Type.ABS, Input.ABS.MT_POSITION_Y) or classify(event) == (Input.Type.ABS, Input.ABS.Y):
-                 if not device.rotated:
-                     ypos = ((100.0 * float(event.ev_value)) /
-                             float(device.app_touchscreen.ymax))
-                 else:
-                     xpos = ((100.0 * float(event.ev_value)) /
-                             float(device.app_touchscreen.xmax))
-        if not (action == 'move' and xpos is None and ypos is None):
-            pretty_interaction = [ "%d" % int(time - last_time)  if last_time is not None else str(0) ] 
-            last_time = time
-            pretty_interaction += [ action ]
-            pretty_interaction += [ str(xpos) if xpos is not None else '--' ]
-            pretty_interaction += [ str(ypos) if ypos is not None else '--' ]
-            print '\t'.join(pretty_interaction)
- 
+            if time is None or event.ev_time > time:
+                time = event.ev_time
+            if event.ev_type != Input.Type.ABS:
+                continue
+            ev_code, ev_value = event.ev_code, event.ev_value
+            if ev_code == Input.ABS.MT_SLOT:
+                slot = ev_value
+                if slot >= len(frame_action):
+                    grow = [ None ] * (slot + 1 - len(frame_action))
+                    for state in (last_x, last_y, frame_action, frame_x, frame_y):
+                        state.extend(grow)
+                continue
+            if ev_code not in (Input.ABS.MT_TRACKING_ID, Input.ABS.MT_POSITION_X,
+                               Input.ABS.MT_POSITION_Y):
+                continue
+            if frame_action[slot] is None:
+                frame_action[slot] = MOVE
+                touched.append(slot)
+            if ev_code == Input.ABS.MT_TRACKING_ID:
+                frame_action[slot] = RELEASE if ev_value == TRACKING_ID_NONE else PRESS
+            elif ev_code == Input.ABS.MT_POSITION_X:
+                frame_x[slot] = last_x[slot] = ev_value
+            else:
+                frame_y[slot] = last_y[slot] = ev_value
+
+        for idx, pointer in enumerate(touched):
+            action, x_value, y_value = frame_action[pointer], frame_x[pointer], frame_y[pointer]
+            frame_action[pointer] = frame_x[pointer] = frame_y[pointer] = None
+            if action == PRESS:
+                x_value, y_value = last_x[pointer], last_y[pointer]
+            xpos, ypos = virtual_position(device, x_value, y_value)
+            if idx == 0:
+                delta = "%d" % int(time - last_time) if last_time is not None else str(0)
+                last_time = time
+            else:
+                delta = str(0)
+            yield '\t'.join([ delta, ACTIONS[action],
+                              str(xpos) if xpos is not None else '--',
+                              str(ypos) if ypos is not None else '--', str(pointer) ])
+        touched = []
+
+
+def virtual_position(device, x_value, y_value):
+    """ Converts raw touchscreen X/Y values (or None) to virtual percentages. """
+    app = device.app_touchscreen
+    if not device.rotated:
+        xpos = (100.0 * float(x_value)) / float(app.xmax) if x_value is not None else None
+        ypos = (100.0 * float(y_value)) / float(app.ymax) if y_value is not None else None
+    else:
+        ypos = ((100.0 * (float(app.ymax) - float(x_value) + float(device.menu_touchscreen.ymax))) /
+                float(app.ymax) if x_value is not None else None)
+        xpos = (100.0 * float(y_value)) / float(app.xmax) if y_value is not None else None
+    return xpos, ypos
+
 
 def translate(args):
     """ TODO """
-    serial_num = get_serial_num(args)
-    touchscreen_device = get_touch_device(adb_shell(serial_num, 'getevent -p'))
+    with STATS.timer('device'):
+        device, touchscreen_device = get_device(args)
     touchscreen_device = int(touchscreen_device.replace('/dev/input/event','').replace(':','')) # hack for now 
 
-    device = Device(serial_num)
-    get_display_info(adb_shell(serial_num, "dumpsys window"), device)
-    get_touchscreen_info(adb_shell(serial_num, "getevent -lp"), device)
+    with STATS.timer('cache'):
+        cache, key = artifact_key(args, device, touchscreen_device)
+        if key is not None and cache.fetch(key, sys.stdout):
+            return
+
+    with STATS.timer('calibration'):
+        template = get_template(args.calibration_file, device, touchscreen_device,
+                                args.template_dir)
+
+    count, events = translate_virtual(args.input_file, template, args.backend,
+                                      args.multitouch, segment_bounds(args))
+    with STATS.timer('output'), artifact_output(cache, key, sys.stdout) as output:
+        print >> output, count
+        output.write(events or '\n')
+
+
+def translate_virtual(trace, template, backend='python', multitouch=False, bounds=None):
+    """ Translates a .virtual trace (a file name, an open file, a PackedTrace
+    or an iterable of lines) with a Template and returns the event count and
+    the newline-terminated reran event lines. bounds (see segment_bounds())
+    selects a range of a trace given by file name. """
+    if bounds is not None and not isinstance(trace, basestring):
+        raise MosaicError('a trace range can only be read from a trace file.')
+    path, trace = trace, as_trace(trace)
+    if multitouch:
+        check_multitouch(backend, trace)
+        if bounds is not None:
+            lines = read_segment(path, **bounds)
+        else:
+            lines = ( line for line in iter_lines(trace) if '#' not in line and line.strip() )
+        rows = STATS.timed(( parse_pointer_row(line) for line in lines ), 'parse', 'rows')
+        with STATS.timer('translate'):
+            count, events = translate_pointers(rows, template)
+    else:
+        with STATS.timer('parse'):
+            if bounds is not None:
+                rows = read_virtual_segment(path, bounds, backend)
+            else:
+                rows = read_virtual(trace, backend)
+        if backend == 'numpy':
+            STATS.count('rows', len(rows))
+        else:
+            rows = STATS.timed(rows, 'parse', 'rows')
+        with STATS.timer('translate'):
+            count, events = translate_rows(rows, template, backend)
+    STATS.count('reran_events', count)
+    return count, events
+
+
+def check_multitouch(backend, trace):
+    if backend != 'python' or isinstance(trace, PackedTrace):
+        raise MosaicError('--multitouch needs text traces and the python backend.')
+
+
+def translate_rows(rows, template, backend='python'):
+    """ Translates parsed virtual rows (see read_virtual()) with a Template and
+    returns the event count and the newline-terminated reran event lines. """
+    if backend == 'numpy':
+        return translate_virtual_array(rows, template)
+    return translate_interactions(rows, template)
+
+
+# Batch translation. The virtual trace is parsed once in the parent; the
+# forked workers inherit it and each translates it for one target.
+
+BATCH_ROWS = None
+
+
+def resolve_target(target_device, args):
+    """ Returns (Device, touch device node) for a profile file or a serial number. """
+    if os.path.isfile(target_device):
+        profile = load_json(target_device)
+        if not is_device_profile(profile):
+            raise MosaicError('cannot read device profile %s.' % target_device)
+        return profile_device(profile)
+    target_args = copy.copy(args)
+    target_args.target_serial_num = target_device
+    target_args.profile_file = None
+    return get_device(target_args)
+
+
+def translate_target(target):
+    """ Pool worker: translates BATCH_ROWS for one target and writes its .reran file. """
+    calibration_file, device, touchscreen_device, output_file, backend, template_dir = target
+    start = time.time()
+    template = get_template(calibration_file, device, touchscreen_device, template_dir)
+    count, events = translate_rows(BATCH_ROWS, template, backend)
+    with open(output_file, 'w') as output:
+        output.write('%d\n' % count)
+        output.write(events or '\n')
+    return output_file, count, time.time() - start
+
+
+def batch_translate(args):
+    """ Translates one virtual trace for many targets on a process pool. """
+    global BATCH_ROWS
+    if not args.targets:
+        raise MosaicError('batch-translate needs at least one target (-T).')
+    targets = []
+    for spec in args.targets:
+        try:
+            calibration_file, target_device, output_file = spec.split(',')
+        except ValueError:
+            raise MosaicError('expected CALIBRATION,DEVICE,OUTPUT but got %s.' % spec)
+        device, touchscreen_device = resolve_target(target_device, args)
+        targets.append((calibration_file, device, extract_device(touchscreen_device),
+                        output_file, args.backend, args.template_dir))
+
+    with STATS.timer('parse'):
+        rows = read_virtual(open_trace(args.input_file), args.backend)
+        BATCH_ROWS = rows if args.backend == 'numpy' else list(rows)
+    STATS.count('rows', len(BATCH_ROWS))
+
+    pool = multiprocessing.Pool(min(args.jobs or multiprocessing.cpu_count(), len(targets)))
+    try:
+        with STATS.timer('translate'):
+            results = pool.map(translate_target, targets, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for output_file, count, seconds in results:
+        print '%s\t%d\t%.3f' % (output_file, count, seconds)
+
+
+def parse_virtual_row(line):
+    """ Splits a virtual row into (time, action, x, y); '--' becomes None. """
+    tokens = line.split()
+    return (int(tokens[0]), tokens[1],
+            float(tokens[2]) if tokens[2] != '--' else None,
+            float(tokens[3]) if tokens[3] != '--' else None)
+
+
+# Translation templates. The press and release interactions of a calibration
+# are compiled once per (calibration, device) into immutable event tuples and
+# reran format strings with slots for the time, X, Y and tracking ids, so
+# translating a row only fills in the slots. Compiled templates are kept in
+# memory and under TEMPLATE_DIR, keyed by the calibration and device hashes.
+
+TEMPLATE_DIR = os.path.join(os.path.expanduser('~'), '.mosaic', 'templates')
+TEMPLATE_VERSION = 2
+CONSTANT, SLOT_X, SLOT_Y, SLOT_TRACKING = range(4)
+TEMPLATES = {}
+
+
+class Template(collections.namedtuple('Template', [ 'touchscreen_device', 'rotated', 'xmax',
+                                                    'ymax', 'xbase', 'press', 'release' ])):
+    """ Compiled translation template. press and release hold one
+    (type, code, value, slot) tuple per event; xmax/ymax are the app
+    touchscreen extents and xbase the X origin of rotated devices. """
+
+    def __new__(cls, touchscreen_device, rotated, xmax, ymax, xbase, press, release):
+        self = super(Template, cls).__new__(cls, touchscreen_device, rotated, xmax, ymax, xbase,
+                                            tuple(map(tuple, press)), tuple(map(tuple, release)))
+        self.press_format, self.press_slots = self.compile(self.press)
+        self.release_format, _ = self.compile(self.release, fill=False)
+        self.tracking_per_press = sum( 1 for event in self.press if event[3] == SLOT_TRACKING )
+        line = '%%d,%d,%d,%d,%%d\n' % (touchscreen_device, Input.Type.ABS, Input.ABS.MT_POSITION_X)
+        line_y = '%%d,%d,%d,%d,%%d\n' % (touchscreen_device, Input.Type.ABS, Input.ABS.MT_POSITION_Y)
+        syn = '1,%d,%d,%d,0\n' % (touchscreen_device, Input.Type.SYN, Input.SYN.REPORT)
+        # Indexed by has_x + 2 * has_y; only the first ABS line carries the row time.
+        self.move_formats = (syn, line + syn, line_y + syn,
+                             line + line_y.replace('%d', '1', 1) + syn)
+        return self
+
+    def compile(self, events, fill=True):
+        """ Returns the reran format string of an interaction and the index of
+        each placeholder in the (time, x, y, tracking ids...) fill tuple.
+        Without fill only the time is a placeholder, as for releases. """
+        lines, slots = [], []
+        tracking = 0
+        for idx, (ev_type, ev_code, ev_value, slot) in enumerate(events):
+            if idx == 0:
+                slots.append(0)
+            if slot == CONSTANT or not fill:
+                value = '%d' % ev_value
+            elif slot == SLOT_TRACKING:
+                value = '%d'
+                slots.append(3 + tracking)
+                tracking += 1
+            else:
+                value = '%d'
+                slots.append(slot)
+            lines.append('%s,%d,%d,%d,%s\n' % ('%d' if idx == 0 else '1', self.touchscreen_device,
+                                               ev_type, ev_code, value))
+        return ''.join(lines), tuple(slots)
+
+
+def event_slot(ev_type, ev_code):
+    if ev_type == Input.Type.ABS:
+        if ev_code in (Input.ABS.MT_POSITION_X, Input.ABS.X):
+            return SLOT_X
+        if ev_code in (Input.ABS.MT_POSITION_Y, Input.ABS.Y):
+            return SLOT_Y
+        if ev_code == Input.ABS.MT_TRACKING_ID:
+            return SLOT_TRACKING
+    return CONSTANT
+
+
+def compile_template(ref_press, ref_release, device, touchscreen_device):
+    """ Compiles reference press/release events into a Template for a device. """
+    app = device.app_touchscreen
+    return Template(touchscreen_device, device.rotated, app.xmax, app.ymax,
+                    device.menu_touchscreen.ymax + app.ymax,
+                    [ (event.ev_type, event.ev_code, event.ev_value,
+                       event_slot(event.ev_type, event.ev_code)) for event in ref_press ],
+                    [ (event.ev_type, event.ev_code, event.ev_value,
+                       event_slot(event.ev_type, event.ev_code)) for event in ref_release ])
+
+
+def template_key(calibration_file, device, touchscreen_device):
+    """ Hashes the calibration contents and the device geometry. """
+    digest = hashlib.sha1('%d\n' % TEMPLATE_VERSION)
+    with open(calibration_file, 'rb') as calibration:
+        for chunk in iter(lambda: calibration.read(1 << 16), ''):
+            digest.update(chunk)
+    digest.update(json.dumps(device_geometry(device, touchscreen_device), sort_keys=True))
+    return digest.hexdigest()
+
+
+def device_geometry(device, touchscreen_device):
+    """ The device profile without its serial number and creation time. """
+    profile = device_profile(device, touchscreen_device)
+    del profile['serial_num'], profile['created']
+    return profile
+
+
+def get_template(calibration_file, device, touchscreen_device, template_dir=None):
+    """ Returns the Template of a calibration file for a device, from memory,
+    from template_dir (the command line passes TEMPLATE_DIR; None disables the
+    on-disk cache) or by compiling it. """
+    try:
+        key = template_key(calibration_file, device, touchscreen_device)
+    except (IOError, OSError) as error:
+        raise MosaicError('cannot read calibration file %s: %s.'
+                          % (calibration_file, error.strerror or error))
+    if key in TEMPLATES:
+        return TEMPLATES[key]
+    path = os.path.join(template_dir, key + '.json') if template_dir else None
+    cached = load_json(path) if path else None
+    if cached is not None:
+        template = Template(**cached)
+    else:
+        model = load_calibration(calibration_file)
+        template = compile_template(model.reference(PRESS), model.reference(RELEASE),
+                                    device, touchscreen_device)
+        if path:
+            save_json(template._asdict(), path)
+    TEMPLATES[key] = template
+    return template
+
+
+# Artifact cache. virtualize and translate keep their output under CACHE_DIR,
+# keyed by a hash of the input trace, the calibration file, the device
+# geometry, the options that change the output and __version__; a hit copies
+# the stored output without parsing anything. Artifacts are evicted least
+# recently used first (their mtime is refreshed on every hit) once the cache
+# grows past --cache-size MiB. Content hashes of the inputs are remembered by
+# size, mtime and inode, so unchanged inputs are not read again.
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.mosaic', 'cache')
+CACHE_SIZE = 1024
+CACHE_DIGESTS = 'digests.json'
+CACHE_STATS = 'stats.json'
+
+
+class TeeFile(object):
+    """ Writes to two files. """
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def write(self, data):
+        self.first.write(data)
+        self.second.write(data)
+
+    def flush(self):
+        self.first.flush()
+        self.second.flush()
+
+
+class ArtifactCache(object):
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_SIZE << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.digests = None
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def file_digest(self, path):
+        """ Returns the SHA-1 of a file's contents. """
+        if self.digests is None:
+            self.digests = load_json(self.path(CACHE_DIGESTS)) or {}
+        status = os.stat(path)
+        stamp = [ status.st_size, status.st_mtime, status.st_ctime, status.st_ino ]
+        real_path = os.path.realpath(path)
+        known = self.digests.get(real_path)
+        if known is not None and known[:-1] == stamp:
+            return known[-1]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 16), ''):
+                digest.update(chunk)
+        self.digests[real_path] = stamp + [ digest.hexdigest() ]
+        try:
+            with self.locked():
+                digests = load_json(self.path(CACHE_DIGESTS)) or {}
+                digests[real_path] = self.digests[real_path]
+                digests = dict( (name, known) for name, known in digests.items()
+                                if os.path.exists(name) )
+                save_json(digests, self.path(CACHE_DIGESTS))
+        except (OSError, IOError):
+            pass
+        return digest.hexdigest()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Serializes the updates of the bookkeeping files across processes. """
+        make_dirs(self.cache_dir)
+        with open(self.path('.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def key(self, action, input_files, options):
+        """ Hashes the inputs and options of an action. """
+        digest = hashlib.sha1('%s\n%s\n' % (__version__, action))
+        for path in input_files:
+            digest.update(self.file_digest(path) + '\n')
+        digest.update(json.dumps(options, sort_keys=True))
+        return digest.hexdigest()
+
+    def fetch(self, key, output):
+        """ Copies the artifact of key to output; returns False on a miss. """
+        path = self.path(key)
+        try:
+            artifact = open(path, 'rb')
+        except IOError:
+            self.record('misses')
+            return False
+        with artifact:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            shutil.copyfileobj(artifact, output, 1 << 20)
+        self.record('hits')
+        return True
+
+    @contextlib.contextmanager
+    def store(self, key, output):
+        """ Yields a file that writes to output and keeps what was written as
+        the artifact of key once the block completes. """
+        make_dirs(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.cache_dir)
+        artifact = os.fdopen(fd, 'wb')
+        try:
+            yield TeeFile(output, artifact)
+            artifact.close()
+            os.rename(tmp_path, self.path(key))
+        finally:
+            if not artifact.closed:
+                artifact.close()
+                os.remove(tmp_path)
+        self.evict()
+
+    def artifacts(self):
+        """ Returns (mtime, size, path) of every artifact, oldest first. """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        artifacts = []
+        for name in os.listdir(self.cache_dir):
+            if len(name) != 40 or name.startswith('.'):
+                continue
+            try:
+                status = os.stat(self.path(name))
+            except OSError:
+                continue
+            artifacts.append((status.st_mtime, status.st_size, self.path(name)))
+        return sorted(artifacts)
+
+    def evict(self):
+        """ Removes the least recently used artifacts above max_bytes. """
+        artifacts = self.artifacts()
+        total = sum( size for mtime, size, path in artifacts )
+        for mtime, size, path in artifacts:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            self.record('evictions')
+
+    def record(self, counter):
+        """ Adds one to a persistent counter; failing to do so never fails
+        the action. """
+        STATS.count('cache_' + counter)
+        try:
+            with self.locked():
+                counters = self.counters()
+                counters[counter] = counters.get(counter, 0) + 1
+                save_json(counters, self.path(CACHE_STATS))
+        except (OSError, IOError):
+            pass
+
+    def counters(self):
+        return load_json(self.path(CACHE_STATS)) or {}
+
+    def clear(self):
+        for mtime, size, path in self.artifacts():
+            os.remove(path)
+        for name in (CACHE_DIGESTS, CACHE_STATS):
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+
+
+def artifact_key(args, device, touchscreen_device):
+    """ Returns (ArtifactCache, key) for the output of a virtualize or
+    translate command line, or (None, None) when it is not cached. """
+    if not args.cache or args.input_file in (None, '-'):
+        return None, None
+    cache = ArtifactCache(args.cache_dir, args.cache_size << 20)
+    options = { 'device': device_geometry(device, touchscreen_device),
+                'multitouch': args.multitouch }
+    if args.action == 'translate':
+        options['bounds'] = segment_bounds(args)
+    input_files = [ path for path in (args.input_file, args.calibration_file) if path is not None ]
+    try:
+        return cache, cache.key(args.action, input_files, options)
+    except (IOError, OSError) as error:
+        raise MosaicError('cannot read %s: %s.' % (error.filename, error.strerror or error))
+
 
-    ref_press, ref_moves, ref_release = get_ref_interactions(open(args.calibration_file))
-    #print [ str(event) for event in ref_press ]
-    #print [ str(event) for event in ref_moves ]
-    #print [ str(event) for event in ref_release ]
-
-    input_file = open(args.input_file, 'r')
-    interaction_stream = filter(lambda line: '#' not in line, input_file.read().splitlines())
-    tracking_id = 34 
-    events = []
-    for interaction in interaction_stream:
-        tokens = interaction.split()
-        if tokens[1] == 'press':
-            for event in ref_press:
-                event.ev_time = 1
-                if classify(event) == (Input.Type.ABS, Input.ABS.MT_POSITION_X) or classify(event) == (Input.Type.ABS, Input.ABS.X):
-                    event.ev_value = (float(tokens[2]) * device.app_touchscreen.xmax) / 100.0 if not device.rotated \
-                                     else device.menu_touchscreen.ymax + device.app_touchscreen.ymax - (float(tokens[3]) * device.app_touchscreen.ymax) / 100.0
-                elif classify(event) == (Input.Type.ABS, Input.ABS.MT_POSITION_Y) or classify(event) == (Input.Type.ABS, Input.ABS.Y):
-                    event.ev_value = (float(tokens[3]) * device.app_touchscreen.ymax) / 100.0 if not device.rotated \
-                                      else  (float(tokens[2]) * device.app_touchscreen.xmax) / 100.0
-                elif classify(event) == (Input.Type.ABS, Input.ABS.MT_TRACKING_ID):
-                    event.ev_value = tracking_id
-                    tracking_id += 1
-#            if int(tokens[0]) != 0:
-#                ref_press[-1].ev_time = int(tokens[0])
-            ref_press[0].ev_time = int(tokens[0])
-            for event in ref_press:
-                tmp =  "%d,%d,%d,%d,%d" % (event.ev_time, touchscreen_device, event.ev_type, event.ev_code, event.ev_value)
-                events.append(tmp)
-        elif tokens[1] == 'release':
-            for event in ref_release:
-                event.ev_time = 1
-            ref_release[0].ev_time = int(tokens[0])
-            for event in ref_release:
-                tmp = "%d,%d,%d,%d,%d" % (event.ev_time, touchscreen_device, event.ev_type, event.ev_code, event.ev_value)
-                events.append(tmp)
+@contextlib.contextmanager
+def artifact_output(cache, key, output):
+    """ Yields output, teeing it into the cache when key is not None. """
+    if key is None:
+        yield output
+        return
+    with cache.store(key, output) as tee:
+        yield tee
+
+
+def show_cache(args):
+    """ Prints the size and the hit/miss counters of the artifact cache. """
+    cache = ArtifactCache(args.cache_dir, args.cache_size << 20)
+    artifacts = cache.artifacts()
+    counters = cache.counters()
+    hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+    print json.dumps({ 'cache_dir': cache.cache_dir,
+                       'artifacts': len(artifacts),
+                       'bytes': sum( size for mtime, size, path in artifacts ),
+                       'max_bytes': cache.max_bytes,
+                       'hits': hits,
+                       'misses': misses,
+                       'evictions': counters.get('evictions', 0),
+                       'hit_rate': float(hits) / (hits + misses) if hits + misses else None },
+                     indent=2, sort_keys=True)
+
+
+def clear_cache(args):
+    ArtifactCache(args.cache_dir, args.cache_size << 20).clear()
+
+
+def translate_interactions(interaction_stream, template, tracking_id=34):
+    """ Expands (time, action, x, y) virtual rows into reran event lines and
+    returns the event count and the text. Presses take tracking ids from
+    tracking_id on. """
+    xmax, ymax, xbase, rotated = template.xmax, template.ymax, template.xbase, template.rotated
+    press_format, release_format = template.press_format, template.release_format
+    move_formats = template.move_formats
+    pick = operator.itemgetter(*template.press_slots)
+    tracking_per_press = template.tracking_per_press
+    press_count, release_count = len(template.press), len(template.release)
+    count = 0
+    output = []
+    append = output.append
+    for time, action, xpos, ypos in interaction_stream:
+        if action == 'press':
+            if not rotated:
+                values = (time, (xpos * xmax) / 100.0, (ypos * ymax) / 100.0)
+            else:
+                values = (time, xbase - (ypos * ymax) / 100.0, (xpos * xmax) / 100.0)
+            values += tuple(xrange(tracking_id, tracking_id + tracking_per_press))
+            tracking_id += tracking_per_press
+            append(press_format % pick(values))
+            count += press_count
+        elif action == 'release':
+            append(release_format % time)
+            count += release_count
+        else:
+            if rotated:
+                xpos, ypos = ypos, xpos
+            if xpos is None:
+                if ypos is None:
+                    append(move_formats[0])
+                    count += 1
+                    continue
+                append(move_formats[2] % (time, (ypos * ymax) / 100.0 if not rotated
+                                                 else (ypos * xmax) / 100.0))
+                count += 2
+                continue
+            abs_x = (xpos * xmax) / 100.0 if not rotated else xbase - (xpos * ymax) / 100.0
+            if ypos is None:
+                append(move_formats[1] % (time, abs_x))
+                count += 2
+            else:
+                append(move_formats[3] % (time, abs_x, (ypos * ymax) / 100.0 if not rotated
+                                                       else (ypos * xmax) / 100.0))
+                count += 3
+    return count, ''.join(output)
+
+
+def parse_pointer_row(line):
+    """ Splits a multi-touch virtual row into (time, action, x, y, pointer). """
+    time, action, xpos, ypos = parse_virtual_row(line)
+    tokens = line.split()
+    return time, action, xpos, ypos, int(tokens[4]) if len(tokens) > 4 else 0
+
+
+def iter_pointer_frames(rows):
+    """ Groups multi-touch rows into frames: a row with a delta of 0 belongs
+    to the frame of the previous row unless that frame already moved its
+    pointer. Yields (delta, rows) per frame. """
+    frame = []
+    pointers = set()
+    for row in rows:
+        if frame and (row[0] != 0 or row[4] in pointers):
+            yield frame[0][0], frame
+            frame = []
+            pointers = set()
+        frame.append(row)
+        pointers.add(row[4])
+    if frame:
+        yield frame[0][0], frame
+
+
+def split_template(events):
+    """ Splits Template event tuples into the per-pointer ABS_MT_* events and
+    the events shared by all pointers, dropping slot selections and reports. """
+    pointer, shared = [], []
+    for event in events:
+        ev_type, ev_code = event[:2]
+        if ev_type == Input.Type.SYN or (ev_type == Input.Type.ABS and ev_code == Input.ABS.MT_SLOT):
+            continue
+        if ev_type == Input.Type.ABS and Input.ABS.MT_TOUCH_MAJOR <= ev_code <= Input.ABS.MT_TOOL_Y:
+            pointer.append(event)
         else:
-            time = int(tokens[0])
-            if (tokens[2] != '--' and not device.rotated) or (tokens[3] != '--' and device.rotated):
-                tmp = "%d,%d,%d,%d,%d" % (time, touchscreen_device, Input.Type.ABS, Input.ABS.MT_POSITION_X, 
-                    (float(tokens[2]) * device.app_touchscreen.xmax) / 100.0 if not device.rotated \
-                     else device.menu_touchscreen.ymax + device.app_touchscreen.ymax - (float(tokens[3]) * device.app_touchscreen.ymax) / 100.0)
-                events.append(tmp)
-                time = 1
-            if (tokens[2] != '--' and device.rotated) or (tokens[3] != '--' and not device.rotated):
-                tmp = "%d,%d,%d,%d,%d" % (time, touchscreen_device, Input.Type.ABS, Input.ABS.MT_POSITION_Y,
-                   (float(tokens[3]) * device.app_touchscreen.ymax) / 100.0 if not device.rotated \
-                    else  (float(tokens[2]) * device.app_touchscreen.xmax) / 100.0)
-                events.append(tmp)
-            tmp = "%d,%d,%d,%d,%d" % (1, touchscreen_device, Input.Type.SYN, Input.SYN.REPORT, 0)
-            events.append(tmp)
-    print len(events)
-    print '\n'.join(events)
+            shared.append(event)
+    return pointer, shared
+
+
+def translate_pointers(rows, template):
+    """ Multi-touch counterpart of translate_interactions(): expands
+    (time, action, x, y, pointer) rows into protocol-B frames that select
+    each pointer's slot and give every press a fresh tracking id. The events
+    shared by all pointers (e.g. BTN_TOUCH) are sent with the first press
+    and the last release. Returns the event count and the text. """
+    press_pointer, press_shared = split_template(template.press)
+    release_pointer, release_shared = split_template(template.release)
+    touchscreen_device = template.touchscreen_device
+    tracking_id = 34
+    active = set()
+    current_slot = None
+    count = 0
+    output = []
+    for delta, frame in iter_pointer_frames(rows):
+        events = []
+        for time, action, xpos, ypos, pointer in frame:
+            abs_x, abs_y = template_position(template, xpos, ypos)
+            if pointer != current_slot:
+                events.append((Input.Type.ABS, Input.ABS.MT_SLOT, pointer))
+                current_slot = pointer
+            if action == 'press':
+                values = { SLOT_X: abs_x, SLOT_Y: abs_y, SLOT_TRACKING: tracking_id }
+                tracking_id += 1
+                fill = press_pointer + (press_shared if not active else [])
+                events += [ (ev_type, ev_code, values.get(slot, ev_value))
+                            for ev_type, ev_code, ev_value, slot in fill ]
+                active.add(pointer)
+                continue
+            if abs_x is not None:
+                events.append((Input.Type.ABS, Input.ABS.MT_POSITION_X, abs_x))
+            if abs_y is not None:
+                events.append((Input.Type.ABS, Input.ABS.MT_POSITION_Y, abs_y))
+            if action == 'release':
+                active.discard(pointer)
+                fill = release_pointer + (release_shared if not active else [])
+                events += [ (ev_type, ev_code, ev_value)
+                            for ev_type, ev_code, ev_value, slot in fill ]
+        events.append((Input.Type.SYN, Input.SYN.REPORT, 0))
+        for idx, (ev_type, ev_code, ev_value) in enumerate(events):
+            output.append("%d,%d,%d,%d,%d\n" % (delta if idx == 0 else 1, touchscreen_device,
+                                                ev_type, ev_code, ev_value))
+        count += len(events)
+    return count, ''.join(output)
+
+
+def template_position(template, xpos, ypos):
+    """ Converts virtual percentages (or None) to touchscreen X/Y values. """
+    if not template.rotated:
+        abs_x = (xpos * template.xmax) / 100.0 if xpos is not None else None
+        abs_y = (ypos * template.ymax) / 100.0 if ypos is not None else None
+    else:
+        abs_x = template.xbase - (ypos * template.ymax) / 100.0 if ypos is not None else None
+        abs_y = (xpos * template.xmax) / 100.0 if xpos is not None else None
+    return abs_x, abs_y
+
+
+# Columnar NumPy backend. Events and virtual rows are held in structured
+# arrays and every per-event step (splitting, classification, coordinate
+# scaling) is an array operation; output is byte-identical to the
+# per-event implementation above.
+
+def load_numpy():
+    """ Imports NumPy and builds the lookup tables of the backend on first
+    use. Returns False when NumPy is not installed. """
+    global np, EVENT_DTYPE, VIRTUAL_DTYPE, DIGITS, POPCOUNT, DIGIT_QUADS, POWERS
+    global TAIL_MASKS
+    if np is not None:
+        return True
+    try:
+        import numpy
+    except ImportError:
+        return False
+
+    EVENT_DTYPE = numpy.dtype([('time', '<i8'), ('type', '<u2'), ('code', '<u2'), ('value', '<u4')])
+    VIRTUAL_DTYPE = numpy.dtype([('time', '<i8'), ('action', 'u1'), ('x', '<f8'), ('y', '<f8')])
+
+    DIGITS = numpy.zeros(256, dtype=numpy.int64)
+    DIGITS[numpy.frombuffer(b'0123456789', dtype=numpy.uint8)] = numpy.arange(10)
+    DIGITS[numpy.frombuffer(b'abcdef', dtype=numpy.uint8)] = numpy.arange(10, 16)
+    DIGITS[numpy.frombuffer(b'ABCDEF', dtype=numpy.uint8)] = numpy.arange(10, 16)
+
+    POPCOUNT = numpy.array([ bin(byte).count('1') for byte in range(256) ], dtype=numpy.int64)
+
+    quads = numpy.arange(10000)[:, None] // numpy.array([1000, 100, 10, 1]) % 10
+    DIGIT_QUADS = (quads + ord('0')).astype(numpy.uint8).view(numpy.uint32).ravel()
+    POWERS = 10 ** numpy.arange(19, dtype=numpy.int64)
+    # Row n keeps the last n of 16 bytes, as two little-endian words.
+    TAIL_MASKS = numpy.tri(17, 16, -1, dtype=numpy.uint8)[:, ::-1] * numpy.uint8(0xff)
+    TAIL_MASKS = TAIL_MASKS.copy().view('<u8')
+    np = numpy
+    return True
+
+
+def require_numpy():
+    if not load_numpy():
+        raise MosaicError('the numpy backend requires NumPy to be installed.')
+
+
+def parse_int_chars(chars, base=16):
+    """ Parses a (tokens, width) matrix of NUL-padded digits into int64. """
+    values = np.zeros(len(chars), dtype=np.int64)
+    for column in chars.T:
+        values = np.where(column != 0, values * base + DIGITS[column], values)
+    return values
+
+
+def split_tokens(text):
+    """ Locates the tokens of text, separated by whitespace (any byte up to
+    ' '), skipping lines that contain a '#' comment. Returns the text as a
+    uint8 array with the start offset and length of every token. """
+    buf = np.frombuffer(text, dtype=np.uint8)
+    separators = np.flatnonzero(buf <= ord(' '))
+    bounds = np.concatenate(([ -1 ], separators, [ len(buf) ]))
+    starts = bounds[:-1] + 1
+    lengths = bounds[1:] - starts
+    tokens = lengths > 0
+    comments = np.flatnonzero(buf == ord('#'))
+    if len(comments):
+        # Token i follows bounds[i]; its line is the number of newlines before it.
+        newlines = buf[separators] == ord('\n')
+        lines = np.concatenate(([ 0 ], np.cumsum(newlines)))
+        commented = np.zeros(lines[-1] + 1, dtype=bool)
+        commented[np.searchsorted(separators[newlines], comments)] = True
+        tokens &= ~commented[lines]
+    return buf, starts[tokens], lengths[tokens]
+
+
+def token_chars(buf, starts, lengths):
+    """ Gathers the given tokens into a (tokens, width) NUL-padded matrix. """
+    width = int(lengths.max()) if len(lengths) else 1
+    offsets = np.arange(width)
+    index = np.where(offsets < lengths[:, None], starts[:, None] + offsets, len(buf))
+    return np.append(buf, np.uint8(0))[index]
+
+
+def parse_decimals(buf, starts, lengths, integer=False):
+    """ Parses decimal tokens like int() (or float()) into int64 (float64).
+    The last 16 bytes of every token are read as two words, and tokens made
+    of digits, a leading '-' and (unless integer) one '.' are decoded eight
+    digits at a time: with the '.' read as a 0 the digits give the mantissa
+    m and the scale k, and m / 10**k is rounded exactly like float() since
+    both fit a double. Longer or other tokens go through int() or float(). """
+    padded = np.concatenate((np.zeros(16, dtype=np.uint8), buf))
+    tails = np.lib.stride_tricks.as_strided(padded, shape=(len(buf) + 1, 16), strides=(1, 1))
+    negative = buf[starts] == ord('-')
+    words = (tails[starts + lengths] - np.uint8(ord('0'))).view('<u8')
+    words &= TAIL_MASKS[np.minimum(lengths - negative, 16)]
+
+    ones, sevens = np.uint64(0x0101010101010101), np.uint64(0x7f7f7f7f7f7f7f7f)
+    points = np.zeros(len(starts), dtype=np.uint64)
+    scale = np.zeros(len(starts), dtype=np.int64)
+    if not integer:
+        # '.' - '0' is 0xfe: flag those bytes with 0x01, then count and clear them.
+        dots = words ^ np.uint64(0xfefefefefefefefe)
+        dots = ~(((dots & sevens) + sevens) | dots | sevens) >> np.uint64(7)
+        points = (dots * ones) >> np.uint64(56)
+        points = points[:, 0] + points[:, 1]
+        words &= ~(dots * np.uint64(0xff))
+        # The byte index of a single flag, read off the top byte of a product.
+        index = (dots * np.uint64(0x0001020304050607)) >> np.uint64(56)
+        scale = np.where(dots[:, 1] != 0, 7 - index[:, 1], 15 - index[:, 0]).astype(np.int64)
+        scale[points == 0] = 0
+    invalid = (words | (words + np.uint64(0x7676767676767676))) & np.uint64(0x8080808080808080)
+    invalid = (invalid[:, 0] | invalid[:, 1]) != 0
+    slow = (lengths > 16) | (lengths - negative - points < 1) | (points > 1) | invalid
+
+    # Pairs, then quads, then octets of digits, most significant byte first.
+    words = (words * np.uint64(10) + (words >> np.uint64(8))) & np.uint64(0x00ff00ff00ff00ff)
+    words = (words * np.uint64(100) + (words >> np.uint64(16))) & np.uint64(0x0000ffff0000ffff)
+    words = (words * np.uint64(10000) + (words >> np.uint64(32))) & np.uint64(0xffffffff)
+    values = (words[:, 0] * np.uint64(100000000) + words[:, 1]).astype(np.int64)
+    if integer:
+        values = np.where(negative, -values, values)
+        convert = int
+    else:
+        shift = POWERS[scale]
+        values = np.where(points > 0, values // (shift * 10) * shift + values % shift, values)
+        values = values / shift.astype(np.float64)
+        values = np.where(negative, -values, values)
+        convert = float
+    for row in np.flatnonzero(slow):
+        start = starts[row]
+        values[row] = convert(buf[start:start + lengths[row]].tostring())
+    return values
+
+
+def parse_event_array(input_event_lines):
+    """ Bulk-parses recorded 'time type code value' lines into an EVENT_DTYPE array. """
+    require_numpy()
+    buf, starts, lengths = split_tokens('\n'.join(input_event_lines))
+    if len(starts) % 4 != 0:
+        raise ValueError('malformed event line')
+    events = np.empty(len(starts) // 4, dtype=EVENT_DTYPE)
+    for column, (field, base, width) in enumerate(( ('time', 10, 18), ('type', 16, 8),
+                                                    ('code', 16, 8), ('value', 16, 8) )):
+        chars = token_chars(buf, starts[column::4], lengths[column::4])
+        if chars.shape[1] > width:
+            raise ValueError('integer field wider than %d digits' % width)
+        events[field] = parse_int_chars(chars, base)
+    return events
+
+
+def iter_event_arrays(input_event_lines, chunk_size=65536):
+    """ Yields event arrays of up to chunk_size lines each. """
+    input_event_lines = iter(input_event_lines)
+    while True:
+        chunk = list(itertools.islice(input_event_lines, chunk_size))
+        if not chunk:
+            return
+        yield parse_event_array(chunk)
+
+
+def signature_array(events):
+    """ Vectorized encode(): packs (type, code, value class) into one int64 key. """
+    ev_type = events['type'].astype(np.int64)
+    ev_code = events['code'].astype(np.int64)
+    ev_value = events['value'].astype(np.int64)
+    keeps_value = (((ev_type == Input.Type.KEY) & (ev_code == Input.KEY.BTN_TOUCH)) |
+                   ((ev_type == Input.Type.ABS) & (ev_code == Input.ABS.MT_TRACKING_ID) &
+                    (ev_value == int('0xffffffff', 16))))
+    return (ev_type << 48) | (ev_code << 32) | np.where(keeps_value, ev_value, 0)
+
+
+def signature_masks(keys, starts, classifier):
+    """ Vectorized SignatureClassifier.mask() over the interactions beginning
+    at starts. """
+    if classifier.bits > 64:
+        raise ValueError('more than 64 calibration signatures')
+    if not classifier.table:
+        return np.zeros(len(starts), dtype=np.uint64)
+    table = sorted( ((ev_type << 48) | (ev_code << 32) | ev_value, bit)
+                    for (ev_type, ev_code, ev_value), bit in classifier.table.items() )
+    table_keys = np.array([ key for key, bit in table ], dtype=np.int64)
+    table_bits = np.array([ bit for key, bit in table ] + [ 0 ], dtype=np.uint64)
+    slots = np.searchsorted(table_keys, keys)
+    slots[table_keys[np.minimum(slots, len(table) - 1)] != keys] = len(table)
+    return np.bitwise_or.reduceat(table_bits[slots], starts)
+
+
+def popcount(masks):
+    return POPCOUNT[masks.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def last_value_per_interaction(mask, interaction_ids, values, num_interactions):
+    """ Returns the last masked value of each interaction, NaN where absent. """
+    result = np.full(num_interactions, np.nan)
+    indices = np.flatnonzero(mask)
+    ids = interaction_ids[indices]
+    last = np.append(ids[1:] != ids[:-1], True)[:len(ids)]
+    result[ids[last]] = values[indices[last]]
+    return result
+
+
+def virtualize_event_arrays(event_arrays, device, classifier):
+    """ Array counterpart of virtualize_interactions(). """
+    require_numpy()
+    last_time = None
+    pending = np.empty(0, dtype=EVENT_DTYPE)
+    for events in event_arrays:
+        events = np.concatenate((pending, events))
+        syn_report = ((events['type'] == Input.Type.SYN) &
+                      (events['code'] == Input.SYN.REPORT))
+        ends = np.flatnonzero(syn_report)
+        if len(ends) == 0:
+            pending = events
+            continue
+        pending = events[ends[-1] + 1:]
+        events = events[:ends[-1] + 1]
+
+        num_interactions = len(ends)
+        starts = np.append(0, ends[:-1] + 1)
+        interaction_ids = np.repeat(np.arange(num_interactions), ends - starts + 1)
+
+        with STATS.timer('classify'):
+            masks = signature_masks(signature_array(events), starts, classifier)
+            press_hits = popcount(masks & np.uint64(classifier.press_mask))
+            release_hits = popcount(masks & np.uint64(classifier.release_mask))
+            actions = np.full(num_interactions, MOVE, dtype=np.uint8)
+            actions[4 * release_hits > classifier.release_threshold] = RELEASE
+            actions[4 * press_hits > classifier.press_threshold] = PRESS
+
+        with STATS.timer('coordinates'):
+            is_abs = events['type'] == Input.Type.ABS
+            x_events = is_abs & ((events['code'] == Input.ABS.MT_POSITION_X) |
+                                 (events['code'] == Input.ABS.X))
+            y_events = is_abs & ((events['code'] == Input.ABS.MT_POSITION_Y) |
+                                 (events['code'] == Input.ABS.Y))
+            values = events['value'].astype(np.float64)
+            x_values = last_value_per_interaction(x_events, interaction_ids, values,
+                                                  num_interactions)
+            y_values = last_value_per_interaction(y_events, interaction_ids, values,
+                                                  num_interactions)
+            if not device.rotated:
+                xpos = (100.0 * x_values) / float(device.app_touchscreen.xmax)
+                ypos = (100.0 * y_values) / float(device.app_touchscreen.ymax)
+            else:
+                ypos = ((100.0 * (float(device.app_touchscreen.ymax) - x_values +
+                        float(device.menu_touchscreen.ymax))) /
+                        float(device.app_touchscreen.ymax))
+                xpos = (100.0 * y_values) / float(device.app_touchscreen.xmax)
+
+        times = np.maximum.reduceat(events['time'], starts)
+        keep = ~((actions == MOVE) & np.isnan(xpos) & np.isnan(ypos))
+        times = times[keep]
+        if len(times) == 0:
+            continue
+        deltas = np.diff(np.append(times[0] if last_time is None else last_time, times))
+        last_time = times[-1]
+        table = np.empty((len(times), 4), dtype=object)
+        table[:, 0] = deltas.tolist()
+        table[:, 1] = np.array(ACTIONS, dtype=object)[actions[keep]]
+        for column, positions in ((2, xpos[keep]), (3, ypos[keep])):
+            table[:, column] = positions.tolist()
+            table[np.isnan(positions), column] = '--'
+        text = ('%s\t%s\t%s\t%s\n' * len(table)) % tuple(table.ravel().tolist())
+        for row in text.splitlines():
+            yield row
+
+
+def parse_virtual_array(interaction_stream):
+    """ Bulk-parses 'time action x y' rows (lines, or larger chunks of text)
+    into a VIRTUAL_DTYPE array; '--' positions become NaN. """
+    require_numpy()
+    buf, starts, lengths = split_tokens('\n'.join(interaction_stream))
+    if len(starts) % 4 != 0:
+        raise ValueError('malformed virtual row')
+    rows = np.empty(len(starts) // 4, dtype=VIRTUAL_DTYPE)
+    try:
+        rows['time'] = parse_decimals(buf, starts[0::4], lengths[0::4], integer=True)
+        actions = buf[starts[1::4]]
+        rows['action'] = np.where(actions == ord('p'), PRESS,
+                                  np.where(actions == ord('r'), RELEASE, MOVE))
+        for column, field in ((2, 'x'), (3, 'y')):
+            position_starts, position_lengths = starts[column::4], lengths[column::4]
+            present = position_lengths != 2
+            present[~present] = ((buf[position_starts[~present]] != ord('-')) |
+                                 (buf[position_starts[~present] + 1] != ord('-')))
+            positions = np.full(len(rows), np.nan)
+            positions[present] = parse_decimals(buf, position_starts[present],
+                                                position_lengths[present])
+            rows[field] = positions
+    except (ValueError, OverflowError):
+        raise ValueError('malformed virtual row')
+    return rows
+
+
+def render_decimals(values):
+    """ Renders an int64 array as right-aligned ASCII decimals, four digits
+    at a time through DIGIT_QUADS. Returns a (len(values), width) uint8
+    matrix and the length of every number, sign included. """
+    magnitude = np.abs(values)
+    digits = np.searchsorted(POWERS[1:], magnitude, side='right') + 1
+    quads = (int(digits.max()) + 3) // 4 if len(values) else 1
+    out = np.empty((len(values), quads + 1), dtype=np.uint32)
+    for column in range(quads, 0, -1):
+        out[:, column] = DIGIT_QUADS.take(magnitude % 10000)
+        magnitude = magnitude // 10000
+    chars = out.view(np.uint8)
+    negative = np.flatnonzero(values < 0)
+    chars[negative, chars.shape[1] - digits[negative] - 1] = ord('-')
+    digits[negative] += 1
+    return chars, digits
+
+
+def translate_virtual_array(rows, template, chunk_size=65536):
+    """ Array counterpart of translate_interactions(); returns the event count
+    and the rendered reran lines. Every row is written with the format that
+    translate_interactions() would fill: the text between its placeholders is
+    copied from the format and only the placeholders are rendered. """
+    require_numpy()
+    if not template.rotated:
+        x_slot = (rows['x'] * template.xmax) / 100.0
+        y_slot = (rows['y'] * template.ymax) / 100.0
+        has_x, has_y = ~np.isnan(rows['x']), ~np.isnan(rows['y'])
+    else:
+        x_slot = float(template.xbase) - (rows['y'] * template.ymax) / 100.0
+        y_slot = (rows['x'] * template.xmax) / 100.0
+        has_x, has_y = ~np.isnan(rows['y']), ~np.isnan(rows['x'])
+
+    actions = rows['action']
+    press = actions == PRESS
+    for slot, values in ((SLOT_X, x_slot), (SLOT_Y, y_slot)):
+        if slot in template.press_slots and np.isnan(values[press]).any():
+            raise ValueError('press row without coordinates')
+
+    # Fill columns as in translate_interactions(): time, x, y, tracking ids.
+    tracking_per_press = template.tracking_per_press
+    fill = np.empty((len(rows), 3 + tracking_per_press), dtype=np.int64)
+    fill[:, 0] = rows['time']
+    fill[:, 1] = np.trunc(np.nan_to_num(x_slot))
+    fill[:, 2] = np.trunc(np.nan_to_num(y_slot))
+    first_tracking_id = 34 + (np.cumsum(press) - 1) * tracking_per_press
+    for index in range(tracking_per_press):
+        fill[:, 3 + index] = first_tracking_id + index
+
+    # Formats by kind: press, release, then moves by has_x + 2 * has_y.
+    formats = [ (template.press_format, template.press_slots), (template.release_format, (0,)),
+                (template.move_formats[0], ()), (template.move_formats[1], (0, 1)),
+                (template.move_formats[2], (0, 2)), (template.move_formats[3], (0, 1, 2)) ]
+    kinds = np.where(press, 0, np.where(actions == RELEASE, 1, 2 + has_x + 2 * has_y))
+    count = int(np.array([ text.count('\n') for text, _ in formats ])[kinds].sum())
+
+    holes = max( len(slots) for _, slots in formats )
+    text_starts = np.zeros((len(formats), holes + 1), dtype=np.int64)
+    text_lengths = np.zeros((len(formats), holes + 1), dtype=np.int64)
+    # The extra fill column is the empty placeholder of formats with fewer holes.
+    hole_columns = np.full((len(formats), holes), fill.shape[1], dtype=np.int64)
+    texts = []
+    offset = 0
+    for kind, (text, slots) in enumerate(formats):
+        for index, part in enumerate(text.split('%d')):
+            text_starts[kind, index], text_lengths[kind, index] = offset, len(part)
+            texts.append(part)
+            offset += len(part)
+        hole_columns[kind, :len(slots)] = slots
+    sources = [ np.frombuffer(''.join(texts), dtype=np.uint8) ]
+
+    # Every fill column is rendered for the rows whose format uses it.
+    uses = np.zeros((len(formats), fill.shape[1] + 1), dtype=bool)
+    uses[np.arange(len(formats))[:, None], hole_columns] = True
+    hole_starts = np.zeros((len(rows), fill.shape[1] + 1), dtype=np.int64)
+    hole_lengths = np.zeros((len(rows), fill.shape[1] + 1), dtype=np.int64)
+    for column in range(fill.shape[1]):
+        used = np.flatnonzero(uses[kinds, column])
+        chars, lengths = render_decimals(fill[used, column])
+        width = chars.shape[1]
+        hole_starts[used, column] = offset + np.arange(len(used)) * width + width - lengths
+        hole_lengths[used, column] = lengths
+        sources.append(chars.ravel())
+        offset += chars.size
+    source = np.concatenate(sources)
+
+    # Rows are sequences of format text and placeholder pieces, copied out of
+    # the source a chunk of rows at a time.
+    lines = np.arange(len(rows))[:, None]
+    piece_starts = np.empty((len(rows), 2 * holes + 1), dtype=np.int64)
+    piece_lengths = np.empty((len(rows), 2 * holes + 1), dtype=np.int64)
+    piece_starts[:, 0::2], piece_lengths[:, 0::2] = text_starts[kinds], text_lengths[kinds]
+    piece_starts[:, 1::2] = hole_starts[lines, hole_columns[kinds]]
+    piece_lengths[:, 1::2] = hole_lengths[lines, hole_columns[kinds]]
+    piece_starts, piece_lengths = piece_starts.ravel(), piece_lengths.ravel()
+    piece_ends = np.cumsum(piece_lengths)
+    shifts = piece_starts - piece_ends + piece_lengths
+    output = []
+    step = chunk_size * (2 * holes + 1)
+    for start in range(0, len(piece_lengths), step):
+        first = piece_ends[start - 1] if start else 0
+        index = np.repeat(shifts[start:start + step], piece_lengths[start:start + step])
+        index += np.arange(first, first + len(index))
+        output.append(source.take(index).tostring())
+    return count, ''.join(output)
+
+
+# Packed traces. A fixed-size header carrying the device geometry (or the
+# virtual orientation) is followed by fixed-width little-endian records:
+#   .events   time:int64 type:uint16 code:uint16 value:uint32
+#   .virtual  time:int64 action:uint8 x:float64 y:float64 (NaN for '--')
+# Readers memory-map the file and unpack records in place; the record
+# layouts match EVENT_DTYPE and VIRTUAL_DTYPE for the NumPy backend.
+
+TRACE_MAGIC = 'MOSAICTR'
+TRACE_VERSION = 1
+TRACE_EVENTS, TRACE_VIRTUAL = 1, 2
+TRACE_HEADER = struct.Struct('<8sHHBBB' + 'IIB' * 7)
+TRACE_HEADER_SIZE = 128
+EVENT_RECORD = struct.Struct('<qHHI')
+VIRTUAL_RECORD = struct.Struct('<qBdd')
+ORIENTATIONS = ('portrait', 'landscape')
+
+
+class PackedTrace(object):
+    """ Memory-mapped reader for packed .events and .virtual traces. """
+
+    def __init__(self, input_file):
+        self.buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = TRACE_HEADER.unpack_from(self.buffer, 0)
+        magic, version, self.kind, has_geometry, rotated, landscape = header[:6]
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError('unsupported packed trace version %d' % version)
+        self.record = EVENT_RECORD if self.kind == TRACE_EVENTS else VIRTUAL_RECORD
+        self.orientation = ORIENTATIONS[landscape] if has_geometry else None
+        self.device = None
+        if has_geometry and self.kind == TRACE_EVENTS:
+            self.device = Device(None)
+            self.device.rotated = bool(rotated)
+            screens = header[6:]
+            for idx, attr in enumerate(SCREENS):
+                xmax, ymax, landscape = screens[3 * idx:3 * idx + 3]
+                setattr(self.device, attr, make_screen(xmax, ymax, ORIENTATIONS[landscape]))
+
+    def __len__(self):
+        return (len(self.buffer) - TRACE_HEADER_SIZE) // self.record.size
+
+    def __iter__(self):
+        unpack_from = self.record.unpack_from
+        size = self.record.size
+        for offset in xrange(TRACE_HEADER_SIZE, TRACE_HEADER_SIZE + len(self) * size, size):
+            yield unpack_from(self.buffer, offset)
+
+    def events(self):
+        return ( Event(*record) for record in self )
+
+    def rows(self):
+        for time, action, xpos, ypos in self:
+            yield (time, ACTIONS[action], xpos if xpos == xpos else None,
+                   ypos if ypos == ypos else None)
+
+    def array(self):
+        """ Zero-copy view of the records as an EVENT_DTYPE/VIRTUAL_DTYPE array. """
+        require_numpy()
+        dtype = EVENT_DTYPE if self.kind == TRACE_EVENTS else VIRTUAL_DTYPE
+        return np.frombuffer(self.buffer, dtype=dtype, count=len(self), offset=TRACE_HEADER_SIZE)
+
+
+def is_packed(input_file):
+    """ Peeks for TRACE_MAGIC; only regular files can be packed traces. """
+    if not stat.S_ISREG(os.fstat(input_file.fileno()).st_mode):
+        return False
+    position = input_file.tell()
+    magic = input_file.read(len(TRACE_MAGIC))
+    input_file.seek(position)
+    return magic == TRACE_MAGIC
+
+
+def open_trace(filename):
+    """ Returns a PackedTrace for packed input, otherwise the text file. """
+    input_file = open_input(filename)
+    return PackedTrace(input_file) if is_packed(input_file) else input_file
+
+
+def as_trace(trace):
+    """ Opens a trace given by file name; open files, PackedTraces and
+    iterables of lines are returned as they are. """
+    if trace is None or isinstance(trace, basestring):
+        return open_trace(trace)
+    return trace
+
+
+def read_events(trace):
+    """ Yields the events of a text or packed .events trace (or file name). """
+    trace = as_trace(trace)
+    if isinstance(trace, PackedTrace):
+        return trace.events()
+    return iter_events(iter_lines(trace))
+
+
+def read_event_arrays(trace, chunk_size=65536):
+    if isinstance(trace, PackedTrace):
+        events = trace.array()
+        return ( events[start:start + chunk_size] for start in xrange(0, len(events), chunk_size) )
+    return iter_event_arrays(iter_lines(trace), chunk_size)
+
+
+def read_virtual_rows(trace):
+    """ Yields (time, action, x, y) rows of a text or packed .virtual trace. """
+    if isinstance(trace, PackedTrace):
+        return trace.rows()
+    return ( parse_virtual_row(line) for line in iter_lines(trace)
+             if '#' not in line and line.strip() )
+
+
+def read_virtual(trace, backend='python'):
+    """ Parses a virtual trace into rows for translate_rows(). """
+    if backend == 'numpy':
+        return read_virtual_array(trace)
+    return read_virtual_rows(trace)
+
+
+def read_virtual_array(trace):
+    if isinstance(trace, PackedTrace):
+        return trace.array()
+    if hasattr(trace, 'read'):
+        return parse_virtual_array([ trace.read() ])
+    return parse_virtual_array(trace)
+
+
+def pack_trace(input_lines, output_file, batch_size=4096):
+    """ Converts a text .events or .virtual trace into the packed format. """
+    input_lines = iter(input_lines)
+    comments = []
+    first_row = None
+    for line in input_lines:
+        if '#' in line or not line.strip():
+            comments.append(line)
+        else:
+            first_row = line
+            break
+    if first_row is not None:
+        virtual = first_row.split()[1] in ACTIONS
+    else:
+        virtual = any('Action' in line for line in comments)
+    if virtual and (any('Pointer' in line for line in comments) or
+                    (first_row is not None and len(first_row.split()) > 4)):
+        raise MosaicError('multi-touch traces cannot be packed.')
+
+    header = [ TRACE_MAGIC, TRACE_VERSION, TRACE_VIRTUAL if virtual else TRACE_EVENTS ]
+    screens = [ 0 ] * (3 * len(SCREENS))
+    if virtual:
+        orientation = [ ORIENTATION_RE.match(line) for line in comments ]
+        orientation = [ r.group(1) for r in orientation if r is not None ]
+        header += [ bool(orientation), 0,
+                    ORIENTATIONS.index(orientation[0]) if orientation else 0 ]
+    else:
+        device = parse_device_header(comments)
+        header += [ device is not None, device is not None and device.rotated, 0 ]
+        if device is not None:
+            screens = []
+            for attr in SCREENS:
+                screen = getattr(device, attr)
+                screens += [ screen.xmax, screen.ymax, ORIENTATIONS.index(screen.orientation) ]
+    output_file.write(TRACE_HEADER.pack(*(header + screens)).ljust(TRACE_HEADER_SIZE, '\0'))
+
+    rows = itertools.chain([ first_row ], input_lines) if first_row is not None else []
+    rows = ( line for line in rows if '#' not in line and line.strip() )
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        if virtual:
+            records = []
+            for line in batch:
+                time, action, xpos, ypos = parse_virtual_row(line)
+                records.append(VIRTUAL_RECORD.pack(time,
+                               ACTIONS.index(action) if action in ACTIONS else MOVE,
+                               xpos if xpos is not None else float('nan'),
+                               ypos if ypos is not None else float('nan')))
+        else:
+            records = []
+            for line in batch:
+                tokens = line.split()
+                records.append(EVENT_RECORD.pack(int(tokens[0]), extract_type(tokens[1]),
+                                                 extract_code(tokens[2]), extract_value(tokens[3])))
+        output_file.write(''.join(records))
+
+
+def unpack_trace(trace):
+    """ Yields the text lines of a packed trace, as record/virtualize print them. """
+    if trace.kind == TRACE_EVENTS:
+        if trace.device is not None:
+            for line in device_header(trace.device):
+                yield line
+            yield '#'
+        yield '# Time Type Code Value'
+        for ev_time, ev_type, ev_code, ev_value in trace:
+            yield '%d %04x %04x %08x' % (ev_time, ev_type, ev_code, ev_value)
+    else:
+        if trace.orientation is not None:
+            yield '# Orientation: %s' % trace.orientation
+            yield '#'
+        yield '# Time Action X Y'
+        for time, action, xpos, ypos in trace.rows():
+            yield '\t'.join([ '%d' % time, action,
+                              str(xpos) if xpos is not None else '--',
+                              str(ypos) if ypos is not None else '--' ])
+
+
+def pack(args):
+    """ Writes the packed form of a text trace to stdout. """
+    pack_trace(iter_lines(open_input(args.input_file)), sys.stdout)
+
+
+def unpack(args):
+    """ Prints a packed trace in its text form. """
+    trace = open_trace(args.input_file)
+    if not isinstance(trace, PackedTrace):
+        raise MosaicError('%s is not a packed trace.' % args.input_file)
+    for line in unpack_trace(trace):
+        print line
+
+
+# Trace indexes. A sparse sidecar (<trace>.idx) records the cumulative
+# time, row number and byte offset of every stride-th row of a .virtual
+# trace (text or packed) or every stride-th frame of a .reran trace, so a
+# time or interaction range can be located by bisection and read without
+# scanning the trace from the beginning.
+
+INDEX_MAGIC = 'MOSAICIX'
+INDEX_VERSION = 1
+INDEX_VIRTUAL, INDEX_PACKED, INDEX_RERAN = 1, 2, 3
+INDEX_HEADER = struct.Struct('<8sHHIqqqq')
+INDEX_ENTRY = struct.Struct('<qqq')
+INDEX_STRIDE = 64
+NS_PER_SEC = 1000000000
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def trace_kind(path):
+    with open(path, 'rb') as input_file:
+        if is_packed(input_file):
+            if PackedTrace(input_file).kind != TRACE_VIRTUAL:
+                raise ValueError('%s is not a virtual or reran trace' % path)
+            return INDEX_PACKED
+        for line in input_file:
+            if '#' in line or not line.strip():
+                continue
+            return INDEX_RERAN if len(line.split()) == 1 else INDEX_VIRTUAL
+    return INDEX_VIRTUAL
+
+
+def iter_trace_rows(path, kind, offset=None):
+    """ Yields (offset, delta, payload) for each row from offset on. The
+    payload is a text line, a packed record tuple or a list of reran lines. """
+    if kind == INDEX_PACKED:
+        trace = PackedTrace(open(path, 'rb'))
+        size = trace.record.size
+        offset = TRACE_HEADER_SIZE if offset is None else offset
+        for offset in xrange(offset, TRACE_HEADER_SIZE + len(trace) * size, size):
+            record = trace.record.unpack_from(trace.buffer, offset)
+            yield offset, record[0], record
+        return
+
+    with open(path, 'rb') as input_file:
+        if offset is not None:
+            input_file.seek(offset)
+        else:
+            offset = 0
+            if kind == INDEX_RERAN:
+                offset += len(input_file.readline())
+        frame = []
+        frame_offset = offset
+        for line in input_file:
+            line_offset = offset
+            offset += len(line)
+            if kind == INDEX_VIRTUAL:
+                if '#' in line or not line.strip():
+                    continue
+                yield line_offset, int(line.split(None, 1)[0]), line
+                continue
+            if not frame:
+                frame_offset = line_offset
+            frame.append(line)
+            fields = line.split(',')
+            if int(fields[2]) == Input.Type.SYN and int(fields[3]) == Input.SYN.REPORT:
+                yield frame_offset, int(frame[0].split(',', 1)[0]), frame
+                frame = []
+
+
+class TraceIndex(object):
+    """ Memory-mapped view of a sidecar index. """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        (magic, version, self.kind, self.stride, self.trace_size, self.trace_mtime,
+         self.rows, self.duration) = INDEX_HEADER.unpack_from(buffer, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('unsupported trace index')
+        self.entries = (len(buffer) - INDEX_HEADER.size) // INDEX_ENTRY.size
+        self.times = IndexColumn(self, 0)
+        self.row_numbers = IndexColumn(self, 1)
+
+    def entry(self, idx):
+        return INDEX_ENTRY.unpack_from(self.buffer, INDEX_HEADER.size + idx * INDEX_ENTRY.size)
+
+
+class IndexColumn(object):
+    """ Lazy sequence over one field of the index entries, for bisect. """
+
+    def __init__(self, index, field):
+        self.index = index
+        self.field = field
+
+    def __len__(self):
+        return self.index.entries
+
+    def __getitem__(self, idx):
+        return self.index.entry(idx)[self.field]
+
+
+def trace_signature(path):
+    info = os.stat(path)
+    return info.st_size, int(info.st_mtime * 1000000)
+
+
+def build_index(path, stride=INDEX_STRIDE):
+    """ Writes the sidecar index of a trace and returns it. """
+    kind = trace_kind(path)
+    entries = []
+    elapsed = 0
+    rows = 0
+    for row, (offset, delta, payload) in enumerate(iter_trace_rows(path, kind)):
+        elapsed += delta
+        if row % stride == 0:
+            entries.append(INDEX_ENTRY.pack(elapsed, row, offset))
+        rows = row + 1
+    trace_size, trace_mtime = trace_signature(path)
+    tmp_path = index_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as output:
+        output.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, kind, stride, trace_size,
+                                       trace_mtime, rows, elapsed))
+        output.write(''.join(entries))
+    os.rename(tmp_path, index_path(path))
+    return load_index(path)
+
+
+def load_index(path):
+    """ Returns the sidecar index of a trace, or None if missing or stale. """
+    try:
+        with open(index_path(path), 'rb') as index_file:
+            index = TraceIndex(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+    except (IOError, ValueError, struct.error, mmap.error):
+        return None
+    if (index.trace_size, index.trace_mtime) != trace_signature(path):
+        return None
+    return index
+
+
+def get_index(path):
+    return load_index(path) or build_index(path)
+
+
+def segment_start(index, time=None, row=None):
+    """ Returns the index entry at or before the first row of the range. """
+    if time is not None:
+        entry = bisect.bisect_left(index.times, time) - 1
+    else:
+        entry = bisect.bisect_right(index.row_numbers, row) - 1
+    return index.entry(max(entry, 0)) if index.entries else None
+
+
+def read_segment(path, start_time=None, end_time=None, start_row=None, end_row=None):
+    """ Yields the payloads of the rows whose cumulative time lies in
+    [start_time, end_time) ns and whose number lies in [start_row, end_row),
+    with the delta of the first row rebased to zero. """
+    index = get_index(path)
+    start_row = start_row or 0
+    entry = max(segment_start(index, time=start_time), segment_start(index, row=start_row))
+    if entry is None:
+        return
+    elapsed, row, offset = entry
+    elapsed -= next(iter_trace_rows(path, index.kind, offset))[1]
+    first = True
+    for offset, delta, payload in iter_trace_rows(path, index.kind, offset):
+        elapsed += delta
+        if (end_row is not None and row >= end_row) or \
+           (end_time is not None and elapsed >= end_time):
+            return
+        if row >= start_row and (start_time is None or elapsed >= start_time):
+            if first:
+                payload = rebase_payload(index.kind, payload)
+                first = False
+            yield payload
+        row += 1
+
+
+def rebase_payload(kind, payload):
+    if kind == INDEX_PACKED:
+        return (0,) + payload[1:]
+    if kind == INDEX_VIRTUAL:
+        return '\t'.join([ '0', payload.split(None, 1)[1] ])
+    return [ '0,' + payload[0].split(',', 1)[1] ] + payload[1:]
+
+
+def segment_bounds(args):
+    """ Returns read_segment() keyword arguments for the range options, or
+    None when no range was requested. """
+    bounds = { 'start_time': args.start_time, 'end_time': args.end_time,
+               'start_row': args.start_interaction, 'end_row': args.end_interaction }
+    if all( value is None for value in bounds.values() ):
+        return None
+    for key in ('start_time', 'end_time'):
+        if bounds[key] is not None:
+            bounds[key] = int(bounds[key] * NS_PER_SEC)
+    return bounds
+
+
+def read_virtual_segment(path, bounds, backend='python'):
+    """ Parses a range of a .virtual trace into rows for translate_rows(). """
+    payloads = read_segment(path, **bounds)
+    if trace_kind(path) == INDEX_PACKED:
+        if backend == 'numpy':
+            require_numpy()
+            return np.array(list(payloads), dtype=VIRTUAL_DTYPE)
+        return ( (time, ACTIONS[action], xpos if xpos == xpos else None,
+                  ypos if ypos == ypos else None)
+                 for time, action, xpos, ypos in payloads )
+    if backend == 'numpy':
+        return parse_virtual_array(payloads)
+    return ( parse_virtual_row(line) for line in payloads )
+
+
+def write_reran_segment(path, bounds, output_file):
+    """ Writes a range of a .reran trace as a stand-alone .reran file. """
+    lines = [ line for frame in read_segment(path, **bounds) for line in frame ]
+    output_file.write('%d\n' % len(lines))
+    output_file.writelines(lines)
+
+
+def index(args):
+    """ Builds the sidecar index of a trace and prints a summary. """
+    trace_index = build_index(args.input_file, args.index_stride)
+    print '%s\t%d rows\t%.3f s' % (index_path(args.input_file), trace_index.rows,
+                                   float(trace_index.duration) / NS_PER_SEC)
+
+
+# Trace compaction. Runs of move rows are decimated with Ramer-Douglas-Peucker
+# on (x %, y %, time ms), scaled so that both tolerances map to a distance of
+# 1. Press and release rows and the last move before each of them are kept.
+
+COMPACT_TOLERANCE = 0.5
+COMPACT_TIME_TOLERANCE = 20.0
+NS_PER_MS = 1000000
+
+
+def segment_offset(point, start, end):
+    """ Vector from the point of the segment start-end closest to point. """
+    direction = [ b - a for a, b in zip(start, end) ]
+    offset = [ p - a for a, p in zip(start, point) ]
+    length = sum( d * d for d in direction )
+    if length:
+        t = max(0.0, min(1.0, sum( d * o for d, o in zip(direction, offset) ) / length))
+        offset = [ o - t * d for o, d in zip(offset, direction) ]
+    return offset
+
+
+def segment_distance(point, start, end):
+    return sum( o * o for o in segment_offset(point, start, end) ) ** 0.5
+
+
+def simplify(points):
+    """ Returns the indexes of the points Ramer-Douglas-Peucker keeps with a
+    tolerance of 1; the first and last points are always kept. """
+    keep = set([ 0, len(points) - 1 ])
+    stack = [ (0, len(points) - 1) ]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, 1.0
+        for idx in xrange(first + 1, last):
+            candidate = segment_distance(points[idx], points[first], points[last])
+            if candidate > distance:
+                farthest, distance = idx, candidate
+        if farthest is not None:
+            keep.add(farthest)
+            stack += [ (first, farthest), (farthest, last) ]
+    return keep
+
+
+def compact_rows(rows, tolerance=COMPACT_TOLERANCE, time_tolerance=COMPACT_TIME_TOLERANCE):
+    """ Marks the rows a compacted trace keeps. rows are (time, action, x, y,
+    pointer) tuples with cumulative times and the pointer's current position;
+    the moves of each pointer are decimated separately. Returns the keep
+    flags and the largest distance of a dropped move from the kept path, in
+    screen percent and in milliseconds. """
+    keep = [ True ] * len(rows)
+    runs = {}
+    deviation = [ 0.0, 0.0 ]
+
+    def close(run):
+        if len(run) < 3:
+            return
+        points = [ (x / tolerance, y / tolerance, float(time) / NS_PER_MS / time_tolerance)
+                   for idx, time, x, y in run ]
+        kept = sorted(simplify(points))
+        for first, last in zip(kept, kept[1:]):
+            for idx in xrange(first + 1, last):
+                keep[run[idx][0]] = False
+                dx, dy, dt = segment_offset(points[idx], points[first], points[last])
+                deviation[0] = max(deviation[0], (dx * dx + dy * dy) ** 0.5 * tolerance)
+                deviation[1] = max(deviation[1], abs(dt) * time_tolerance)
+
+    for idx, (time, action, x, y, pointer) in enumerate(rows):
+        if action == 'move' and x is not None and y is not None:
+            runs.setdefault(pointer, []).append((idx, time, x, y))
+            continue
+        # The row before a run anchors it but is never dropped.
+        close(runs.pop(pointer, []))
+        if action != 'move' and x is not None and y is not None:
+            runs[pointer] = [ (None, time, x, y) ]
+    for run in runs.values():
+        close(run)
+    return keep, tuple(deviation)
+
+
+def compact_trace(lines, output, tolerance=COMPACT_TOLERANCE,
+                  time_tolerance=COMPACT_TIME_TOLERANCE):
+    """ Writes the compacted form of a text .virtual trace (single pointer or
+    multi-touch) and returns the rows in, the rows out and the maximum
+    deviation (percent, milliseconds). """
+    comments, fields, rows = [], [], []
+    positions = {}
+    elapsed = 0
+    for line in lines:
+        line = line.rstrip('\n')
+        if '#' in line or not line.strip():
+            if not fields:
+                comments.append(line)
+            continue
+        tokens = line.split()
+        elapsed += int(tokens[0])
+        pointer = tokens[4] if len(tokens) > 4 else None
+        x, y = positions.get(pointer, (None, None))
+        x = float(tokens[2]) if tokens[2] != '--' else x
+        y = float(tokens[3]) if tokens[3] != '--' else y
+        positions[pointer] = (x, y)
+        fields.append(tokens)
+        rows.append((elapsed, tokens[1], x, y, pointer))
+    keep, deviation = compact_rows(rows, tolerance, time_tolerance)
+
+    for line in comments:
+        output.write(line + '\n')
+    last_time = None
+    written = {}
+    kept = 0
+    for (time, action, x, y, pointer), tokens, kept_row in zip(rows, fields, keep):
+        if not kept_row:
+            continue
+        tokens = list(tokens)
+        tokens[0] = '%d' % (time - last_time) if last_time is not None else '0'
+        last_time = time
+        if action == 'move':
+            # Coordinates last set by dropped moves are carried by the kept one.
+            last_x, last_y = written.get(pointer, (None, None))
+            if tokens[2] == '--' and x != last_x:
+                tokens[2] = str(x)
+            if tokens[3] == '--' and y != last_y:
+                tokens[3] = str(y)
+        written[pointer] = (x, y)
+        output.write('\t'.join(tokens) + '\n')
+        kept += 1
+    return len(rows), kept, deviation
+
+
+def compact(args):
+    """ Writes a compacted .virtual trace to stdout and reports the savings. """
+    if args.tolerance <= 0 or args.time_tolerance <= 0:
+        raise MosaicError('compaction tolerances must be positive.')
+    trace = open_trace(args.input_file)
+    lines = unpack_trace(trace) if isinstance(trace, PackedTrace) else iter_lines(trace)
+    rows_in, rows_out, deviation = compact_trace(lines, sys.stdout, args.tolerance,
+                                                 args.time_tolerance)
+    print >> sys.stderr, 'rows: %d -> %d (%.2fx), max deviation: %.3f%% / %.3f ms' % (
+        (rows_in, rows_out, float(rows_in) / rows_out if rows_out else 1.0) + deviation)
+
+
+# Synthetic workloads. generate writes the .virtual trace of a declarative
+# JSON scenario without a device or a recording:
+#
+#   { "orientation": "portrait", "rate": 120, "seed": 7, "pause": 0.2,
+#     "repeat": 1,
+#     "steps": [
+#       { "type": "tap", "grid": [3, 4], "margin": 10, "hold": 0.05 },
+#       { "type": "tap", "points": [[50, 50]], "repeat": 3 },
+#       { "type": "swipe", "from": [50, 80], "to": [50, 20], "duration": 0.3,
+#         "curve": "ease-in-out" },
+#       { "type": "fling", "from": [50, 80], "to": [50, 20] },
+#       { "type": "monkey", "gestures": 1000000, "mix": ["tap", "swipe", "fling"] },
+#       { "type": "pause", "duration": 1.0 } ] }
+#
+# Positions are in screen percent and times in seconds. Strokes report one
+# move per frame at the given rate (Hz), placed along the path by the
+# velocity curve. Every gesture is followed by a pause, and 'pause',
+# 'rate' and 'repeat' can be set per step. Rows are streamed as they are
+# generated, and the same scenario always produces the same trace.
+
+GENERATE_RATE = 120.0
+GENERATE_PAUSE = 0.2
+GENERATE_HOLD = 0.05
+GENERATE_MIX = ('tap', 'swipe', 'fling')
+STROKES = { 'swipe': ('linear', 0.3, (0.1, 0.6)),
+            'fling': ('ease-out', 0.1, (0.05, 0.15)) }
+CURVES = { 'linear': lambda progress: progress,
+           'ease-in': lambda progress: progress ** 3,
+           'ease-out': lambda progress: 1.0 - (1.0 - progress) ** 3,
+           'ease-in-out': lambda progress: progress * progress * (3.0 - 2.0 * progress) }
+# Malformed values in a scenario surface as these while its rows are generated.
+SCENARIO_ERRORS = (TypeError, ValueError, KeyError, AttributeError, ZeroDivisionError)
+
+
+class ScenarioGenerator(object):
+    """ Yields the (time in seconds, action, x, y) rows of a scenario. """
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.random = random.Random(scenario.get('seed', 0))
+        self.time = 0.0
+
+    def rows(self):
+        for _ in xrange(self.scenario.get('repeat', 1)):
+            for number, step in enumerate(self.scenario.get('steps', []), 1):
+                try:
+                    for _ in xrange(step.get('repeat', 1)):
+                        for row in self.step(step):
+                            yield row
+                except SCENARIO_ERRORS as error:
+                    raise MosaicError('invalid scenario step %d: %s.' % (number, error))
+
+    def step(self, step):
+        kind = step.get('type')
+        pause = step.get('pause', self.scenario.get('pause', GENERATE_PAUSE))
+        rate = step.get('rate', self.scenario.get('rate', GENERATE_RATE))
+        if kind == 'pause':
+            self.time += step.get('duration', pause)
+            return
+        if kind == 'tap':
+            for x, y in tap_points(step):
+                for row in self.tap(x, y, step.get('hold', GENERATE_HOLD)):
+                    yield row
+                self.time += pause
+        elif kind in STROKES:
+            curve, duration, durations = STROKES[kind]
+            start, end = screen_point(step.get('from')), screen_point(step.get('to'))
+            for row in self.stroke(start, end, step.get('duration', duration),
+                                   step.get('curve', curve), rate):
+                yield row
+            self.time += pause
+        elif kind == 'monkey':
+            for row in self.monkey(step, pause, rate):
+                yield row
+        else:
+            raise MosaicError('unknown scenario step type %s.' % kind)
+
+    def tap(self, x, y, hold):
+        yield self.time, PRESS, x, y
+        self.time += hold
+        yield self.time, RELEASE, None, None
+
+    def stroke(self, start, end, duration, curve, rate):
+        if curve not in CURVES:
+            raise MosaicError('unknown velocity curve %s (%s).' % (curve, ', '.join(sorted(CURVES))))
+        easing = CURVES[curve]
+        frames = max(1, int(round(duration * rate)))
+        interval = float(duration) / frames
+        (x0, y0), (x1, y1) = start, end
+        yield self.time, PRESS, x0, y0
+        for frame in xrange(1, frames + 1):
+            self.time += interval
+            progress = easing(float(frame) / frames)
+            yield self.time, MOVE, x0 + (x1 - x0) * progress, y0 + (y1 - y0) * progress
+        self.time += interval
+        yield self.time, RELEASE, None, None
+
+    def monkey(self, step, pause, rate):
+        """ Random gestures; 'seed' gives the monkey its own random stream. """
+        chance = random.Random(step['seed']) if 'seed' in step else self.random
+        mix = step.get('mix', GENERATE_MIX)
+        if not mix or any( kind != 'tap' and kind not in STROKES for kind in mix ):
+            raise MosaicError('monkey gestures must be among %s.' % ', '.join(GENERATE_MIX))
+        pauses = step.get('pauses', [ pause / 4.0, pause * 2.0 ])
+        point = lambda: (chance.uniform(0.0, 100.0), chance.uniform(0.0, 100.0))
+        for _ in xrange(step.get('gestures', 100)):
+            kind = chance.choice(mix)
+            if kind == 'tap':
+                x, y = point()
+                rows = self.tap(x, y, chance.uniform(GENERATE_HOLD / 2.0, GENERATE_HOLD * 2.0))
+            else:
+                curve, duration, durations = STROKES[kind]
+                if kind == 'swipe':
+                    curve = chance.choice(sorted(CURVES))
+                rows = self.stroke(point(), point(), chance.uniform(*durations), curve, rate)
+            for row in rows:
+                yield row
+            self.time += chance.uniform(*pauses)
+
+
+def screen_point(point):
+    """ Checks that point is an [x, y] pair of screen percentages. """
+    if point is None or len(point) != 2 or \
+       any( not isinstance(value, (int, long, float)) or not 0 <= value <= 100
+            for value in point ):
+        raise MosaicError('expected an [x, y] position in screen percent but got %s.' % (point,))
+    return float(point[0]), float(point[1])
+
+
+def tap_points(step):
+    """ The explicit points of a tap step, or the centers of the cells of
+    its grid (columns, rows) within the margin, row by row. """
+    if 'points' in step:
+        return [ screen_point(point) for point in step['points'] ]
+    grid = step.get('grid', [ 1, 1 ])
+    if not isinstance(grid, list) or len(grid) != 2 or \
+       any( not isinstance(count, (int, long)) or isinstance(count, bool) or count < 1
+            for count in grid ):
+        raise MosaicError('expected a [columns, rows] grid of positive integers but got %s.'
+                          % (grid,))
+    margin = step.get('margin', 0.0)
+    if not isinstance(margin, (int, long, float)) or isinstance(margin, bool) or \
+       not 0 <= margin < 50:
+        raise MosaicError('expected a grid margin from 0 to under 50 percent but got %s.'
+                          % (margin,))
+    columns, rows = grid
+    width, height = (100.0 - 2 * margin) / columns, (100.0 - 2 * margin) / rows
+    return [ screen_point([ margin + (column + 0.5) * width, margin + (row + 0.5) * height ])
+             for row in xrange(rows) for column in xrange(columns) ]
+
+
+def generate_virtual(scenario):
+    """ Yields the lines of the .virtual trace of a scenario (a dict), header
+    first. """
+    orientation = scenario.get('orientation', 'portrait')
+    if orientation not in ORIENTATIONS:
+        raise MosaicError('orientation must be one of %s.' % ', '.join(ORIENTATIONS))
+    yield '# Orientation: %s' % orientation
+    yield '#'
+    yield '# Time Action X Y'
+    last_time = 0
+    for seconds, action, xpos, ypos in ScenarioGenerator(scenario).rows():
+        time = int(round(seconds * NS_PER_SEC))
+        yield '%d\t%s\t%s\t%s' % (time - last_time, ACTIONS[action],
+                                  str(xpos) if xpos is not None else '--',
+                                  str(ypos) if ypos is not None else '--')
+        last_time = time
+
+
+def generate(args):
+    """ Writes the .virtual trace of the scenario -i to stdout. """
+    try:
+        scenario = json.load(open_input(args.input_file))
+    except ValueError as error:
+        raise MosaicError('cannot parse scenario %s: %s' % (args.input_file, error))
+    try:
+        for line in STATS.timed(generate_virtual(scenario), 'generate'):
+            sys.stdout.write(line + '\n')
+    except SCENARIO_ERRORS as error:
+        raise MosaicError('invalid scenario %s: %s.' % (args.input_file, error))
+
 
 def replay(args):
     """ TODO """
     serial_num = get_serial_num(args)
-    print '\n'.join(adb_push(serial_num,args.input_file))
-    adb_shell(serial_num,'su -c /data/reran/reran /sdcard/' + args.input_file)
+    input_file = args.input_file
+    bounds = segment_bounds(args)
+    if bounds is not None:
+        workdir = tempfile.mkdtemp(prefix='mosaic-replay-')
+        input_file = os.path.join(workdir, os.path.basename(args.input_file))
+        with STATS.timer('segment'), open(input_file, 'w') as segment:
+            write_reran_segment(args.input_file, bounds, segment)
+    with STATS.timer('push'):
+        print '\n'.join(adb_push(serial_num,input_file))
+    with STATS.timer('replay'):
+        list(adb_shell(serial_num,'su -c /data/reran/reran /sdcard/' + os.path.basename(input_file)))
+    if bounds is not None:
+        shutil.rmtree(workdir)
+
+
+# Fleet replay. Each device gets a thread that pushes the trace (unless the
+# on-device copy already has the same MD5) and opens a root shell ('adb
+# shell su' reading commands from a pipe), then waits on a barrier so reran
+# is started on all devices at the same moment. Only the reran command is
+# written after the barrier: the start and wall time exclude the start-up of
+# adb and su. The shell echoes a marker once su is up and the exit status of
+# reran when it ends.
+
+REMOTE_DIR = '/sdcard/'
+RERAN = '/data/reran/reran'
+REPLAY_READY = re.compile(r'__mosaic_ready__$')
+REPLAY_STATUS = re.compile(r'__mosaic_status__ ([0-9]+)$')
+
+
+class Barrier(object):
+    """ Blocks callers of wait() until parties threads have arrived. """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.arrived += 1
+            if self.arrived >= self.parties:
+                self.condition.notify_all()
+            while self.arrived < self.parties:
+                self.condition.wait()
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def replay_on_device(serial_num, filename, md5, transfers, barrier, reran, result):
+    """ Thread body for fleet_replay(); fills in the result dict with either
+    an error or the start, end and exit status of reran. """
+    remote_file = REMOTE_DIR + os.path.basename(filename)
+    shell = None
+    try:
+        transport = get_transport(serial_num)
+        returncode, stdout, stderr = transport.call('md5sum ' + remote_file)
+        result['pushed'] = returncode != 0 or stdout.split()[:1] != [ md5 ]
+        if result['pushed']:
+            with transfers:
+                transport.push(filename, REMOTE_DIR)
+        shell = transport.stream('su', stdin=subprocess.PIPE)
+        shell.stdin.write('exec 2>&1\necho "__mosaic_""ready__"\n')
+        shell.stdin.flush()
+        if not wait_for_line(shell.stdout, REPLAY_READY):
+            raise MosaicError('cannot start a root shell on %s.' % serial_num)
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        barrier.wait()
+    try:
+        if 'error' in result:
+            return
+        result['start'] = time.time()
+        shell.stdin.write('%s %s; echo "__mosaic_""status__ $?"\n' % (reran, remote_file))
+        shell.stdin.flush()
+        r = wait_for_line(shell.stdout, REPLAY_STATUS)
+        result['end'] = time.time()
+        if r is None:
+            raise MosaicError('the shell of %s exited during the replay.' % serial_num)
+        result['status'] = int(r.group(1))
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        if shell is not None:
+            close_shell(shell)
+
+
+def wait_for_line(output, pattern):
+    """ Reads output up to a line matching pattern; returns the match, or
+    None at the end of the output. """
+    for line in iter(output.readline, ''):
+        r = pattern.search(line.rstrip('\r\n'))
+        if r is not None:
+            return r
+    return None
+
+
+def close_shell(shell):
+    """ Ends the root shell of a replay and discards its remaining output. """
+    try:
+        shell.stdin.write('exit\n')
+        shell.stdin.close()
+    except IOError:
+        pass
+    shell.stdout.read()
+    shell.wait()
+
+
+def fleet_replay(args):
+    """ Replays a translated trace on several devices with a synchronized start. """
+    serial_nums = args.serial_nums or adb_devices()
+    md5 = file_md5(args.input_file)
+    transfers = threading.BoundedSemaphore(args.max_transfers)
+    barrier = Barrier(len(serial_nums))
+    results = [ { 'serial_num': serial_num } for serial_num in serial_nums ]
+    threads = [ threading.Thread(target=replay_on_device,
+                                 args=(serial_num, args.input_file, md5, transfers,
+                                       barrier, args.reran, result))
+                for serial_num, result in zip(serial_nums, results) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    starts = [ result['start'] for result in results if 'start' in result ]
+    first_start = min(starts) if starts else 0
+    print '# Serial Pushed Status Start(ms) Wall(s)'
+    for result in results:
+        if 'error' in result:
+            print '%s\t%s\terror: %s' % (result['serial_num'], result.get('pushed', '--'),
+                                         result['error'])
+            continue
+        print '%s\t%s\t%d\t%.1f\t%.3f' % (result['serial_num'], result['pushed'], result['status'],
+                                          1000.0 * (result['start'] - first_start),
+                                          result['end'] - result['start'])
+    if starts:
+        print '# Start spread: %.1f ms' % (1000.0 * (max(starts) - first_start))
+    failed = sum( 'error' in result or result['status'] != 0 for result in results )
+    if failed:
+        sys.stdout.flush()
+        raise MosaicError('replay failed on %d of %d devices.' % (failed, len(results)))
 
 
 def get_serial_num(args):
@@ -418,60 +3038,689 @@ def get_serial_num(args):
         if len(connected_devices) == 1:
             serial_num =  connected_devices[0]
         else:
-            print >> sys.stderr, 'Error: More than one device and emulator ' \
-                                 'connected.'
-            sys.exit(1)
+            raise MosaicError('More than one device and emulator connected.')
     return serial_num
 
 
-def adb_getevent(serial_num):
-    adb_args = ['adb', '-s', serial_num, 'shell', 'getevent', '-tt']
-    adb = subprocess.Popen(adb_args, stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
-    try:
-        while True:
-            yield adb.stdout.readline().strip()
-    except KeyboardInterrupt:
-        return
+def spawn_getevent(serial_num):
+    return get_transport(serial_num).stream('getevent -tt')
+
+
+_clock_gettime = None
+
+
+def monotonic():
+    """ Seconds from CLOCK_MONOTONIC (falls back to time.time()). """
+    global _clock_gettime
+    if _clock_gettime is None:
+        try:
+            import ctypes
+            import ctypes.util
+
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            spec = timespec()
+
+            def clock_gettime():
+                libc.clock_gettime(1, ctypes.byref(spec))
+                return spec.tv_sec + spec.tv_nsec * 1e-9
+            clock_gettime()
+            _clock_gettime = clock_gettime
+        except (OSError, AttributeError, TypeError):
+            _clock_gettime = time.time
+    return _clock_gettime()
+
+
+class Recorder(object):
+    """ Reads the 'getevent -tt' stream of a device in large chunks on a
+    reader thread and hands formatted event lines to the writer through a
+    bounded queue; the reader blocks when the writer falls behind, so no
+    input is discarded. Recording stops on EOF or SIGINT. """
+
+    def __init__(self, adb, touchscreen_device, output, queue_size=256, chunk_size=65536):
+        self.adb = adb
+        self.touchscreen_device = touchscreen_device
+        self.output = output
+        self.queue = Queue.Queue(queue_size)
+        self.chunk_size = chunk_size
+        self.lines_read = 0
+        self.events_written = 0
+        self.malformed = 0
+        self.syn_dropped = 0
+        self.out_of_order = 0
+        self.max_queue_depth = 0
+        self.max_lag = 0.0
+
+    def read(self):
+        fd = self.adb.stdout.fileno()
+        partial = ''
+        last_time = None
+        try:
+            while True:
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    break
+                lines = (partial + chunk).split('\n')
+                partial = lines.pop()
+                self.lines_read += len(lines)
+                batch = []
+                for line in lines:
+                    if not valid(self.touchscreen_device, line):
+                        continue
+                    tokens = extract_tokens(line.strip())
+                    try:
+                        ev_time = extract_time(tokens[0])
+                        ev_type, ev_code, ev_value = tokens[2], tokens[3], tokens[4]
+                    except (IndexError, ValueError):
+                        self.malformed += 1
+                        continue
+                    if extract_type(ev_type) == Input.Type.SYN and \
+                       extract_code(ev_code) == Input.SYN.DROPPED:
+                        self.syn_dropped += 1
+                    if last_time is not None and ev_time < last_time:
+                        self.out_of_order += 1
+                    last_time = ev_time
+                    batch.append('%d %s %s %s\n' % (ev_time, ev_type, ev_code, ev_value))
+                if batch:
+                    self.queue.put((monotonic(), batch))
+                    self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+            if partial.strip():
+                self.malformed += 1
+        finally:
+            self.queue.put(None)
+
+    def stop(self, *args):
+        if self.adb.poll() is None:
+            try:
+                self.adb.terminate()
+            except OSError:
+                pass
+
+    def run(self):
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        previous_handler = signal.signal(signal.SIGINT, self.stop)
+        reader.start()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    break
+                self.write(*item)
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            self.output.flush()
+
+    def write(self, enqueued, batch):
+        self.max_lag = max(self.max_lag, monotonic() - enqueued)
+        self.output.writelines(batch)
+        self.events_written += len(batch)
+
+    def report(self):
+        return ('# Recorded %d events from %d lines; dropped: %d malformed, '
+                '%d SYN_DROPPED, %d out of order; max queue depth %d/%d, max lag %.1f ms'
+                % (self.events_written, self.lines_read, self.malformed, self.syn_dropped,
+                   self.out_of_order, self.max_queue_depth, self.queue.maxsize,
+                   1000.0 * self.max_lag))
 
 
 def record(args):
     """ TODO """
-    serial_num = get_serial_num(args)
-    touchscreen_device = get_touch_device(adb_shell(serial_num, 'getevent -p'))
+    with STATS.timer('device'):
+        device, touchscreen_device = get_device(args)
 
-    device = Device(serial_num)
-    get_display_info(adb_shell(serial_num, "dumpsys window"), device)
-    get_touchscreen_info(adb_shell(serial_num, "getevent -lp"), device)
-
-    print "# Default Display: %s" % device.init_display
-    print "# Current Display: %s" % device.cur_display
-    print "# App Display: %s" % device.app_display
-    print "# Rotated: %s" % str(device.rotated)
-    print "# Default Touchscreen: %s" % device.init_touchscreen
-    print "# Current Touchscreen: %s" % device.cur_touchscreen
-    print "# App Touchscreen: %s" % device.app_touchscreen
-    print "# Menu Touchscreen: %s" % device.menu_touchscreen
+    for line in device_header(device):
+        print line
     print "#"
     print "# Time Type Code Value"
-
-    touchscreen_events = itertools.ifilter(lambda input_event_line: 
-                 valid(touchscreen_device, input_event_line),
-                 adb_getevent(serial_num))
-
-    for event in touchscreen_events:
-        tokens =  extract_tokens(event)
-        print extract_time(tokens[0]),tokens[2],tokens[3],tokens[4]
+    sys.stdout.flush()
+
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1 << 16)
+    recorder = Recorder(spawn_getevent(device.serial_num), touchscreen_device, output)
+    with STATS.timer('record'):
+        recorder.run()
+    STATS.count('lines', recorder.lines_read)
+    STATS.count('events', recorder.events_written)
+    STATS.count('dropped', recorder.malformed + recorder.syn_dropped + recorder.out_of_order)
+    print >> sys.stderr, recorder.report()
+
+
+# Live mirroring. The getevent stream of the source device (-r) is read as
+# by record, and every interaction is virtualized and translated as soon as
+# its SYN_REPORT arrives. The events are written as one batch of sendevent
+# commands per interaction to a single persistent 'adb shell' on the target
+# device (-t), followed by an echo of the batch number. The shell echoes it
+# once every sendevent of the batch has run, so latencies are measured up to
+# the injection on the device rather than up to the local pipe. Move frames
+# are skipped while the oldest unacknowledged batch is older than the
+# latency bound, which keeps the backlog on the device bounded; a move only
+# carries the axes that changed, so the coordinates of skipped moves are
+# sent with the next move, or before the release that ends the gesture.
+
+MIRROR_MAX_LATENCY = 50.0
+MIRROR_ACK = re.compile(r'__mosaic_ack__ ([0-9]+)$')
+
+
+def spawn_shell(serial_num):
+    shell = get_transport(serial_num).stream(stdin=subprocess.PIPE)
+    shell.stdin.write('exec 2>&1\n')
+    return shell
+
+
+class Mirror(Recorder):
+    """ Recorder whose writer side virtualizes, translates and injects each
+    interaction on the target and keeps per-frame and per-gesture latencies
+    (from reading the source to the acknowledgement of the target). """
+
+    def __init__(self, adb, touchscreen_device, device, classifier, shell, target_node,
+                 template, max_latency=MIRROR_MAX_LATENCY):
+        Recorder.__init__(self, adb, touchscreen_device, shell.stdin)
+        self.device = device
+        self.classifier = classifier
+        self.shell = shell
+        self.target_node = target_node
+        self.template = template
+        self.max_latency = max_latency / 1000.0
+        self.interaction = []
+        self.tracking_id = 34
+        self.carried = (None, None)
+        self.batches = 0
+        self.in_flight = collections.deque()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.gesture_latencies = []
+        self.gesture_latency = None
+        self.skipped = 0
+
+    def run(self):
+        acks = threading.Thread(target=self.read_acks)
+        acks.daemon = True
+        acks.start()
+        try:
+            Recorder.run(self)
+        finally:
+            try:
+                self.shell.stdin.close()
+            except IOError:
+                pass
+        acks.join()
+
+    def read_acks(self):
+        for line in iter(self.shell.stdout.readline, ''):
+            r = MIRROR_ACK.search(line.rstrip('\r\n'))
+            if r is not None:
+                self.acknowledge(int(r.group(1)), monotonic())
+
+    def acknowledge(self, batch, now):
+        """ Completes every batch up to the acknowledged one; the shell runs
+        them in order. """
+        with self.lock:
+            while self.in_flight and self.in_flight[0][0] <= batch:
+                number, enqueued, action = self.in_flight.popleft()
+                latency = now - enqueued
+                self.latencies.append(latency)
+                if action == PRESS:
+                    self.gesture_latency = latency
+                elif self.gesture_latency is not None:
+                    self.gesture_latency = max(self.gesture_latency, latency)
+                    if action == RELEASE:
+                        self.gesture_latencies.append(self.gesture_latency)
+                        self.gesture_latency = None
+
+    def write(self, enqueued, batch):
+        for line in batch:
+            ev_time, ev_type, ev_code, ev_value = line.split()
+            event = Event(int(ev_time), extract_type(ev_type), extract_code(ev_code),
+                          extract_value(ev_value))
+            self.interaction.append(event)
+            if event.ev_type == Input.Type.SYN and event.ev_code == Input.SYN.REPORT:
+                self.send(enqueued, self.interaction)
+                self.interaction = []
+        self.events_written += len(batch)
+
+    def send(self, enqueued, interaction):
+        row = virtualize_interaction(interaction, self.device, self.classifier)
+        if row is None:
+            return
+        time, action, xpos, ypos = row
+        with self.lock:
+            oldest = self.in_flight[0][1] if self.in_flight else enqueued
+        if action == MOVE:
+            # Coordinates last set by skipped moves are carried by the next one sent.
+            xpos = self.carried[0] if xpos is None else xpos
+            ypos = self.carried[1] if ypos is None else ypos
+            if monotonic() - oldest > self.max_latency:
+                self.carried = (xpos, ypos)
+                self.skipped += 1
+                return
+        rows = [ (0, ACTIONS[action], xpos, ypos) ]
+        if action == RELEASE and self.carried != (None, None):
+            # The final position of the gesture was in a skipped move.
+            rows.insert(0, (0, ACTIONS[MOVE]) + self.carried)
+        self.carried = (None, None)
+        count, events = translate_interactions(rows, self.template, self.tracking_id)
+        if action == PRESS:
+            self.tracking_id += self.template.tracking_per_press
+        commands = []
+        for line in events.splitlines():
+            ev_type, ev_code, ev_value = line.split(',')[2:]
+            commands.append('sendevent %s %s %s %d\n' % (self.target_node, ev_type, ev_code,
+                                                          signed_value(int(ev_value))))
+        self.batches += 1
+        commands.append('echo "__mosaic_""ack__ %d"\n' % self.batches)
+        with self.lock:
+            self.in_flight.append((self.batches, enqueued, action))
+        self.shell.stdin.write(''.join(commands))
+        self.shell.stdin.flush()
+
+    def report(self):
+        ms = lambda value: 1000.0 * value if value is not None else float('nan')
+        frames, gestures = percentiles(self.latencies), percentiles(self.gesture_latencies)
+        over = sum( 1 for latency in self.latencies if latency > self.max_latency )
+        return ('# Mirrored %d gestures (%d frames, %d skipped, %d unacknowledged, %d over '
+                '%.0f ms); frame latency p50 %.1f / p99 %.1f / max %.1f ms; gesture latency '
+                'p50 %.1f / max %.1f ms'
+                % (len(self.gesture_latencies), len(self.latencies), self.skipped,
+                   len(self.in_flight), over,
+                   1000.0 * self.max_latency, ms(frames['p50']), ms(frames['p99']),
+                   ms(frames['max']), ms(gestures['p50']), ms(gestures['max'])))
+
+
+def mirror(args):
+    """ Mirrors the touch input of the source device (-r) on the target (-t). """
+    if args.ref_serial_num is None or args.target_calibration_file is None:
+        raise MosaicError('mirror needs a source device (-r) and a target '
+                          'calibration file (--target-calib).')
+    source_args = copy.copy(args)
+    source_args.target_serial_num = args.ref_serial_num
+    source_args.profile_file = None
+    source, source_touch = get_device(source_args)
+    classifier = load_calibration(args.calibration_file).classifier()
+
+    target, target_touch = get_device(args)
+    target_device = extract_device(target_touch)
+    template = get_template(args.target_calibration_file, target, target_device,
+                            args.template_dir)
+
+    shell = spawn_shell(target.serial_num)
+    session = Mirror(spawn_getevent(source.serial_num), source_touch, source, classifier, shell,
+                     '/dev/input/event%d' % target_device, template, args.max_latency)
+    try:
+        session.run()
+    finally:
+        if shell.poll() is None:
+            try:
+                shell.stdin.close()
+            except IOError:
+                pass
+            shell.wait()
+    print >> sys.stderr, session.report()
+
+
+# Benchmark harness. Synthetic 'getevent -tt' traces are generated for a
+# fixed virtual device and pushed through record, virtualize and translate
+# without any device attached. Every stage runs in a forked child so its
+# peak RSS can be read from wait4(); timing fidelity is measured by
+# comparing the frame times reconstructed from the .virtual and .reran
+# outputs with the generated ground truth.
+
+BENCH_TOUCH_DEVICE = '/dev/input/event1'
+BENCH_GESTURES = ('tap', 'swipe', 'fling', 'multi')
+
+
+def bench_device():
+    device = Device('benchmark')
+    get_display_info([ 'init=1080x1920 cur=1080x1920 app=1080x1794' ], device)
+    get_touchscreen_info([ 'ABS_MT_POSITION_X : max 1079', 'ABS_MT_POSITION_Y : max 1919' ], device)
+    return device
 
 
-def parse_args():
+class SyntheticTrace(object):
+    """ Writes synthetic protocol-B 'getevent -tt' output for a mix of
+    gestures and keeps the time of every frame (SYN_REPORT) as ground truth. """
+
+    def __init__(self, rate=120.0, seed=0, mix=BENCH_GESTURES):
+        self.interval = 1.0 / rate
+        self.random = random.Random(seed)
+        self.mix = mix
+        self.time = 1000.0
+        self.tracking_id = 0
+        self.frames = []
+        self.events = 0
+
+    def frame(self, output, events):
+        stamp = '[%14.6f] %s:' % (self.time, BENCH_TOUCH_DEVICE)
+        for ev_type, ev_code, ev_value in events + [ (Input.Type.SYN, Input.SYN.REPORT, 0) ]:
+            output.write('%s %04x %04x %08x\n' % (stamp, ev_type, ev_code, ev_value & 0xffffffff))
+        self.events += len(events) + 1
+        self.frames.append(extract_time('%.6f' % self.time))
+        self.time += self.interval
+
+    def stroke(self, output, starts, ends, frames, easing):
+        """ One gesture of len(starts) fingers moving from starts to ends. """
+        press = []
+        for slot, (x, y) in enumerate(starts):
+            if len(starts) > 1:
+                press.append((Input.Type.ABS, Input.ABS.MT_SLOT, slot))
+            press += [ (Input.Type.ABS, Input.ABS.MT_TRACKING_ID, self.tracking_id),
+                       (Input.Type.ABS, Input.ABS.MT_POSITION_X, x),
+                       (Input.Type.ABS, Input.ABS.MT_POSITION_Y, y) ]
+            self.tracking_id += 1
+        self.frame(output, press + [ (Input.Type.KEY, Input.KEY.BTN_TOUCH, 1) ])
+        for step in range(1, frames + 1):
+            progress = easing(float(step) / frames)
+            move = []
+            for slot, ((x0, y0), (x1, y1)) in enumerate(zip(starts, ends)):
+                if len(starts) > 1:
+                    move.append((Input.Type.ABS, Input.ABS.MT_SLOT, slot))
+                move += [ (Input.Type.ABS, Input.ABS.MT_POSITION_X, int(x0 + (x1 - x0) * progress)),
+                          (Input.Type.ABS, Input.ABS.MT_POSITION_Y, int(y0 + (y1 - y0) * progress)) ]
+            self.frame(output, move)
+        release = []
+        for slot in range(len(starts)):
+            if len(starts) > 1:
+                release.append((Input.Type.ABS, Input.ABS.MT_SLOT, slot))
+            release.append((Input.Type.ABS, Input.ABS.MT_TRACKING_ID, -1))
+        self.frame(output, release + [ (Input.Type.KEY, Input.KEY.BTN_TOUCH, 0) ])
+
+    def gesture(self, output, kind):
+        point = lambda: (self.random.randint(0, 1079), self.random.randint(0, 1919))
+        linear = lambda progress: progress
+        if kind == 'tap':
+            start = point()
+            self.stroke(output, [ start ], [ start ], self.random.randint(0, 2), linear)
+        elif kind == 'swipe':
+            self.stroke(output, [ point() ], [ point() ], self.random.randint(10, 40), linear)
+        elif kind == 'fling':
+            self.stroke(output, [ point() ], [ point() ], self.random.randint(4, 12),
+                        lambda progress: 1.0 - (1.0 - progress) ** 3)
+        else:
+            self.stroke(output, [ point(), point() ], [ point(), point() ],
+                        self.random.randint(10, 30), linear)
+        self.time += self.random.uniform(0.05, 0.5)
+
+    def write(self, output, gestures):
+        for _ in xrange(gestures):
+            self.gesture(output, self.random.choice(self.mix))
+
+    def calibration(self, output):
+        self.stroke(output, [ (200, 1500) ], [ (800, 300) ], 20, lambda progress: progress)
+
+
+def run_stage(stage, *args):
+    """ Runs stage(*args) in a forked child and returns its result together
+    with the wall time and the child's peak RSS in KiB. """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = time.time()
+            result = stage(*args)
+            os.write(write_fd, json.dumps({ 'result': result, 'seconds': time.time() - start }))
+        except BaseException as e:
+            os.write(write_fd, json.dumps({ 'error': '%s: %s' % (type(e).__name__, e) }))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    data = ''.join(iter(lambda: os.read(read_fd, 65536), ''))
+    os.close(read_fd)
+    _, status, rusage = os.wait4(pid, 0)
+    outcome = json.loads(data) if data else { 'error': 'stage exited with status %d' % status }
+    outcome['peak_rss_kb'] = rusage.ru_maxrss
+    return outcome
+
+
+def bench_record(getevent_file, events_file):
+    device = bench_device()
+    with open(events_file, 'w') as output:
+        for line in device_header(device):
+            output.write(line + '\n')
+        output.write('#\n# Time Type Code Value\n')
+        adb = subprocess.Popen(['cat', getevent_file], stdout=subprocess.PIPE)
+        recorder = Recorder(adb, BENCH_TOUCH_DEVICE, output)
+        recorder.run()
+    return recorder.events_written
+
+
+def bench_virtualize(calibration_file, events_file, virtual_file, backend):
+    device = bench_device()
+    classifier = load_calibration(calibration_file).classifier()
+    rows = 0
+    with open(virtual_file, 'w') as output:
+        output.write('# Time Action X Y\n')
+        for row in virtualize_trace(open_trace(events_file), device, classifier, backend):
+            output.write(row + '\n')
+            rows += 1
+    return rows
+
+
+def bench_translate(calibration_file, virtual_file, reran_file, backend):
+    device = bench_device()
+    template = get_template(calibration_file, device, extract_device(BENCH_TOUCH_DEVICE))
+    count, events = translate_rows(read_virtual(open_trace(virtual_file), backend), template,
+                                   backend)
+    with open(reran_file, 'w') as output:
+        output.write('%d\n' % count)
+        output.write(events)
+    return count
+
+
+def virtual_frame_times(virtual_file):
+    elapsed = 0
+    times = []
+    for time, action, xpos, ypos in read_virtual_rows(open(virtual_file)):
+        elapsed += time
+        times.append(elapsed)
+    return times
+
+
+def reran_frame_times(reran_file):
+    elapsed = 0
+    times = []
+    with open(reran_file) as reran:
+        reran.readline()
+        for line in reran:
+            ev_time, ev_device, ev_type, ev_code, ev_value = line.split(',')
+            elapsed += int(ev_time)
+            if int(ev_type) == Input.Type.SYN and int(ev_code) == Input.SYN.REPORT:
+                times.append(elapsed)
+    return times
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return { 'p50': None, 'p99': None, 'max': None }
+    rank = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return { 'p50': rank(0.50), 'p99': rank(0.99), 'max': values[-1] }
+
+
+def timing_error(truth, times):
+    """ Drift of each reconstructed frame time from the ground truth and the
+    error of each inter-frame interval, in milliseconds. """
+    truth = [ frame - truth[0] for frame in truth ]
+    frames = min(len(truth), len(times))
+    drift = [ abs(times[i] - truth[i]) / 1e6 for i in xrange(frames) ]
+    interval = [ abs((times[i] - times[i - 1]) - (truth[i] - truth[i - 1])) / 1e6
+                 for i in xrange(1, frames) ]
+    return { 'frames_expected': len(truth), 'frames_emitted': len(times),
+             'drift_ms': percentiles(drift), 'interval_error_ms': percentiles(interval) }
+
+
+def benchmark(args):
+    """ Prints a JSON report of per-stage throughput, peak memory and timing error. """
+    mix = tuple(args.bench_mix.split(','))
+    workdir = tempfile.mkdtemp(prefix='mosaic-bench-')
+    path = lambda name: os.path.join(workdir, name)
+    try:
+        trace = SyntheticTrace(args.bench_rate, args.bench_seed, mix)
+        with open(path('calibration.getevent'), 'w') as output:
+            trace.calibration(output)
+        bench_record(path('calibration.getevent'), path('calibration.events'))
+        trace = SyntheticTrace(args.bench_rate, args.bench_seed, mix)
+        with open(path('trace.getevent'), 'w') as output:
+            trace.write(output, args.bench_gestures)
+
+        backends = [ 'python' ] + ([ 'numpy' ] if load_numpy() else [])
+        stages = {}
+        stages['record'] = run_stage(bench_record, path('trace.getevent'), path('trace.events'))
+        for backend in backends:
+            stages['virtualize.' + backend] = run_stage(
+                bench_virtualize, path('calibration.events'), path('trace.events'),
+                path('trace.%s.virtual' % backend), backend)
+            stages['translate.' + backend] = run_stage(
+                bench_translate, path('calibration.events'), path('trace.%s.virtual' % backend),
+                path('trace.%s.reran' % backend), backend)
+        stages['baseline'] = run_stage(lambda: 0)
+        for name, stage in stages.items():
+            if 'seconds' in stage and name != 'baseline':
+                stage['events_per_sec'] = (trace.events / stage['seconds']
+                                           if stage['seconds'] > 0 else None)
+
+        report = {
+            'python': platform.python_version(),
+            'numpy': np.__version__ if np is not None else None,
+            'config': { 'gestures': args.bench_gestures, 'rate_hz': args.bench_rate,
+                        'seed': args.bench_seed, 'mix': list(mix),
+                        'events': trace.events, 'frames': len(trace.frames) },
+            'stages': stages,
+            'timing': {
+                'virtualize': timing_error(trace.frames, virtual_frame_times(path('trace.python.virtual'))),
+                'translate': timing_error(trace.frames, reran_frame_times(path('trace.python.reran'))),
+            },
+        }
+        print json.dumps(report, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Instrumentation. STATS accumulates the wall time of each stage (exclusive
+# of the stages nested in it) and event counters for the running action.
+# --stats prints the report as JSON on stderr, and every function passed to
+# add_stats_hook() is called with the report dict; --cprofile writes a
+# cProfile dump of the action. Nothing is measured unless one of them is used.
+
+class Stats(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.stack = []
+        self.last = None
+        self.started = None
+
+    def start(self):
+        self.reset()
+        self.started = monotonic()
+
+    def enter(self, stage):
+        now = monotonic()
+        if self.stack:
+            self.timers[self.stack[-1]] += now - self.last
+        self.stack.append(stage)
+        self.last = now
+
+    def leave(self):
+        now = monotonic()
+        self.timers[self.stack.pop()] += now - self.last
+        self.last = now
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+        self.enter(stage)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def timed(self, iterable, stage, counter=None, weight=None):
+        """ Charges the time spent producing each item of iterable to stage
+        and adds one (or weight(item)) to counter per item. """
+        if not self.enabled:
+            return iterable
+        return self.iter_timed(iter(iterable), stage, counter, weight)
+
+    def iter_timed(self, iterator, stage, counter, weight):
+        while True:
+            self.enter(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            if counter is not None:
+                self.counters[counter] += weight(item) if weight is not None else 1
+            yield item
+
+    def timed_call(self, function, stage):
+        """ Returns function, charging the time of each call to stage. """
+        if not self.enabled:
+            return function
+        def timed_function(*args):
+            self.enter(stage)
+            try:
+                return function(*args)
+            finally:
+                self.leave()
+        return timed_function
+
+    def count(self, counter, value=1):
+        if self.enabled:
+            self.counters[counter] += value
+
+    def report(self, action=None):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return { 'action': action,
+                 'wall': monotonic() - self.started if self.started is not None else None,
+                 'stages': dict(self.timers),
+                 'counters': dict(self.counters),
+                 'peak_rss_kib': usage.ru_maxrss,
+                 'children_peak_rss_kib': children.ru_maxrss }
+
+
+STATS = Stats()
+STATS_HOOKS = []
+
+
+def add_stats_hook(hook):
+    """ Registers hook(report) to be called with the stats of each action. """
+    STATS_HOOKS.append(hook)
+    STATS.enabled = True
+
+
+def emit_stats(args, error=None):
+    report = STATS.report(args.action)
+    report['error'] = error
+    for hook in STATS_HOOKS:
+        hook(report)
+    if args.stats:
+        print >> sys.stderr, json.dumps(report, sort_keys=True)
+
+
+def parse_args(argv=None):
+    import argparse
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('-a','--action', dest='action', 
                         help='action to perform', 
                         default=None, metavar='')
     
     parser.add_argument('-c','--calib-file', dest='calibration_file', 
-                        help='calibration file', 
+                        help='calibration recording or model', 
                         default=None, metavar='')
 
 
@@ -483,16 +3732,145 @@ def parse_args():
                         help='reference device serial number', 
                         default=None, metavar='')
     parser.add_argument('-i','--input-file', dest='input_file', 
-                        help='input file', 
+                        help='input file (\'-\' reads from stdin)', 
                         default=None, metavar='')
 
-    return parser.parse_args()
+    parser.add_argument('-b','--backend', dest='backend',
+                        help='event processing backend (python or numpy)',
+                        choices=['python', 'numpy'], default='python', metavar='')
 
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='print per-stage timings and counters as JSON on stderr')
 
-def main():
+    parser.add_argument('--cprofile', dest='cprofile_file',
+                        help='write a cProfile dump of the action to this file',
+                        default=None, metavar='')
+
+    parser.add_argument('--transport', dest='transport',
+                        help='device command transport (persistent, spawn or local)',
+                        choices=sorted(TRANSPORT_TYPES), default=TRANSPORT, metavar='')
+
+    parser.add_argument('--local-root', dest='local_root',
+                        help='directory receiving pushed files with --transport local',
+                        default=LOCAL_ROOT, metavar='')
+
+    parser.add_argument('--profile', dest='profile_file',
+                        help='device profile file to use instead of querying the device',
+                        default=None, metavar='')
+
+    parser.add_argument('--profile-dir', dest='profile_dir',
+                        help='device profile cache directory',
+                        default=PROFILE_DIR, metavar='')
+
+    parser.add_argument('--profile-ttl', dest='profile_ttl', type=float,
+                        help='seconds before a cached device profile is refreshed',
+                        default=PROFILE_TTL, metavar='')
+
+    parser.add_argument('--refresh-profile', dest='refresh_profile', action='store_true',
+                        help='ignore the cached device profile and query the device')
+
+    parser.add_argument('--no-profile-check', dest='profile_check', action='store_false',
+                        help='do not check a cached profile for rotation/resolution changes')
+
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='use the cached device profile without contacting the device')
+
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        help='virtualize/translate artifact cache directory',
+                        default=CACHE_DIR, metavar='')
+
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+                        help='artifact cache size limit in MiB',
+                        default=CACHE_SIZE, metavar='')
+
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='neither read nor store virtualize/translate artifacts')
+
+    parser.add_argument('-T','--target', dest='targets', action='append',
+                        help='batch-translate target as CALIBRATION,DEVICE,OUTPUT where '
+                             'DEVICE is a profile file or a serial number (repeatable)',
+                        default=None, metavar='')
+
+    parser.add_argument('-j','--jobs', dest='jobs', type=int,
+                        help='number of worker processes (default: one per CPU)',
+                        default=None, metavar='')
+
+    parser.add_argument('-D','--device', dest='serial_nums', action='append',
+                        help='fleet-replay device serial number (repeatable; '
+                             'default: all connected devices)',
+                        default=None, metavar='')
 
-    args = parse_args()
+    parser.add_argument('--max-transfers', dest='max_transfers', type=int,
+                        help='maximum number of concurrent adb pushes',
+                        default=4, metavar='')
 
+    parser.add_argument('--reran', dest='reran',
+                        help='path of the reran binary on the device',
+                        default=RERAN, metavar='')
+
+    parser.add_argument('--target-calib', dest='target_calibration_file',
+                        help='mirror: calibration file of the target device',
+                        default=None, metavar='')
+
+    parser.add_argument('--max-latency', dest='max_latency', type=float,
+                        help='mirror: milliseconds after which move frames are skipped',
+                        default=MIRROR_MAX_LATENCY, metavar='')
+
+    parser.add_argument('--multitouch', dest='multitouch', action='store_true',
+                        help='virtualize/translate one pointer stream per finger')
+
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        help='compact: allowed deviation of dropped moves in screen percent',
+                        default=COMPACT_TOLERANCE, metavar='')
+
+    parser.add_argument('--time-tolerance', dest='time_tolerance', type=float,
+                        help='compact: allowed deviation of dropped moves in milliseconds',
+                        default=COMPACT_TIME_TOLERANCE, metavar='')
+
+    parser.add_argument('--template-dir', dest='template_dir',
+                        help='directory of cached translation templates',
+                        default=TEMPLATE_DIR, metavar='')
+
+    parser.add_argument('--start-time', dest='start_time', type=float,
+                        help='translate/replay only rows at or after this many seconds',
+                        default=None, metavar='')
+
+    parser.add_argument('--end-time', dest='end_time', type=float,
+                        help='translate/replay only rows before this many seconds',
+                        default=None, metavar='')
+
+    parser.add_argument('--start-interaction', dest='start_interaction', type=int,
+                        help='translate/replay only from this interaction number on',
+                        default=None, metavar='')
+
+    parser.add_argument('--end-interaction', dest='end_interaction', type=int,
+                        help='translate/replay only interactions before this number',
+                        default=None, metavar='')
+
+    parser.add_argument('--index-stride', dest='index_stride', type=int,
+                        help='rows between trace index entries',
+                        default=INDEX_STRIDE, metavar='')
+
+    parser.add_argument('--bench-gestures', dest='bench_gestures', type=int,
+                        help='number of synthetic gestures in the benchmark trace',
+                        default=2000, metavar='')
+
+    parser.add_argument('--bench-rate', dest='bench_rate', type=float,
+                        help='touchscreen sampling rate of the benchmark trace in Hz',
+                        default=120.0, metavar='')
+
+    parser.add_argument('--bench-seed', dest='bench_seed', type=int,
+                        help='random seed of the benchmark trace',
+                        default=0, metavar='')
+
+    parser.add_argument('--bench-mix', dest='bench_mix',
+                        help='comma-separated gestures to draw from (%s)' % ','.join(BENCH_GESTURES),
+                        default=','.join(BENCH_GESTURES), metavar='')
+
+    return parser.parse_args(argv)
+
+
+def run_action(args):
     if args.action == 'record':
         record(args)
     elif args.action == 'virtualize':
@@ -501,7 +3879,74 @@ def main():
         translate(args)
     elif args.action == 'replay':
         replay(args)
+    elif args.action == 'fleet-replay':
+        fleet_replay(args)
+    elif args.action == 'benchmark':
+        benchmark(args)
+    elif args.action == 'mirror':
+        mirror(args)
+    elif args.action == 'compact':
+        compact(args)
+    elif args.action == 'index':
+        index(args)
+    elif args.action == 'pack':
+        pack(args)
+    elif args.action == 'unpack':
+        unpack(args)
+    elif args.action == 'batch-translate':
+        batch_translate(args)
+    elif args.action == 'profile':
+        show_profile(args)
+    elif args.action == 'invalidate-profile':
+        invalidate_profile(args)
+    elif args.action == 'generate':
+        generate(args)
+    elif args.action == 'learn':
+        learn(args)
+    elif args.action == 'cache':
+        show_cache(args)
+    elif args.action == 'clear-cache':
+        clear_cache(args)
+
+
+def run(argv=None):
+    """ Runs a mosaic.py command line (sys.argv[1:] by default) in this
+    process. Errors raise MosaicError. """
+    global TRANSPORT, LOCAL_ROOT
+    args = parse_args(argv)
+    TRANSPORT, LOCAL_ROOT = args.transport, args.local_root
+
+    if args.backend == 'numpy':
+        require_numpy()
+
+    STATS.enabled = bool(STATS_HOOKS) or args.stats
+    STATS.start()
+    error = None
+    try:
+        if args.cprofile_file is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run_action, args)
+            finally:
+                profiler.dump_stats(args.cprofile_file)
+        else:
+            run_action(args)
+    except BaseException as e:
+        error = str(e) or type(e).__name__
+        raise
+    finally:
+        emit_stats(args, error)
 
+
+def main():
+    try:
+        run()
+    except MosaicError as error:
+        print >> sys.stderr, 'Error: %s' % error
+        sys.exit(1)
     sys.exit(0)
 
-main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+""" Checks that the NumPy backend writes the same bytes as the python backend. """
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mosaic
+
+
+@unittest.skipUnless(mosaic.load_numpy(), 'NumPy is not installed')
+class BackendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        trace = mosaic.SyntheticTrace(seed=7)
+        for name, write in (('calibration', trace.calibration),
+                            ('trace', lambda output: trace.write(output, 200))):
+            getevent_file = cls.path(name + '.getevent')
+            with open(getevent_file, 'w') as output:
+                write(output)
+            mosaic.bench_record(getevent_file, cls.path(name + '.events'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.directory, name)
+
+    def read(self, name):
+        with open(self.path(name)) as trace:
+            return trace.read()
+
+    def test_virtualize(self):
+        for backend in ('python', 'numpy'):
+            mosaic.bench_virtualize(self.path('calibration.events'), self.path('trace.events'),
+                                    self.path(backend + '.virtual'), backend)
+        self.assertEqual(self.read('numpy.virtual'), self.read('python.virtual'))
+
+    def test_translate(self):
+        mosaic.bench_virtualize(self.path('calibration.events'), self.path('trace.events'),
+                                self.path('input.virtual'), 'python')
+        for backend in ('python', 'numpy'):
+            mosaic.bench_translate(self.path('calibration.events'), self.path('input.virtual'),
+                                   self.path(backend + '.reran'), backend)
+        self.assertEqual(self.read('numpy.reran'), self.read('python.reran'))
+
+    def test_virtualize_lines(self):
+        device = mosaic.bench_device()
+        classifier = mosaic.load_calibration(self.path('calibration.events')).classifier()
+        lines = self.read('trace.events').splitlines()
+        python, numpy = [ list(mosaic.virtualize_events(lines, device, classifier, backend))
+                          for backend in ('python', 'numpy') ]
+        self.assertGreater(len(numpy), 3)
+        self.assertEqual(numpy, python)
+
+    def test_parse_events(self):
+        lines = [ '# comment 1 2 3\n', '1000001 0003 0035 0000021c\n', '\n',
+                  '1000002 0001 014a 00000001 # 4\n', '1000003 0000 0000 00000000' ]
+        events = mosaic.parse_event_array(lines)
+        expected = [ (event.ev_time, event.ev_type, event.ev_code, event.ev_value)
+                     for event in mosaic.iter_events(lines) ]
+        self.assertEqual(events.tolist(), expected)
+
+    def test_parse_virtual(self):
+        lines = [ '# Time Action X Y\n', '0\tpress\t51.5895147797\t-0.0\n',
+                  '16666\tmove\t--\t1e-05\n', '#\n', '# 1 2 3 4\n',
+                  '7\tmove\t-12.5\t--\n', '\n', '123456789012\trelease\t100.0\t2.5e+20\n',
+                  '3\tmove\t0.1\t33.333333333333336' ]
+        rows = mosaic.parse_virtual_array(lines)
+        expected = [ (time, mosaic.ACTIONS.index(action), x, y)
+                     for time, action, x, y in mosaic.read_virtual_rows(lines) ]
+        self.assertEqual(len(rows), len(expected))
+        for row, (time, action, x, y) in zip(rows.tolist(), expected):
+            self.assertEqual(row[:2], (time, action))
+            for value, position in zip(row[2:], (x, y)):
+                if position is None:
+                    self.assertNotEqual(value, value)
+                else:
+                    self.assertEqual(repr(value), repr(position))
+
+    def test_parse_positions(self):
+        positions = [ repr(value) for value in (0.0, 1.0, 99.99999999999999, 0.1 + 0.2, 1e-7,
+                                                 12345678.5, 0.123456789012345678, 7.0 / 3) ]
+        positions += [ '5', '-5.', '.5', '0050.50', '1234567890123456.0' ]
+        lines = [ '%d\tmove\t%s\t%s\n' % (index, position, position)
+                  for index, position in enumerate(positions) ]
+        rows = mosaic.parse_virtual_array(lines)
+        for row, position in zip(rows.tolist(), positions):
+            self.assertEqual(repr(row[2]), repr(float(position)))
+
+    def test_malformed_virtual(self):
+        for lines in ([ '0\tpress\t1.0\n' ], [ '0\tpress\t1.0\tx\n' ]):
+            self.assertRaises(ValueError, mosaic.parse_virtual_array, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+""" Checks the sentinel protocol of ShellTransport over a local sh. """
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mosaic
+
+
+class EchoingTransport(mosaic.LocalTransport):
+    """ LocalTransport whose shell echoes every command line it reads. """
+
+    def shell_args(self, cmd=None):
+        return [ 'sh', '-v' ] + ([ '-c', cmd ] if cmd else [])
+
+
+class ShellTransportTest(unittest.TestCase):
+
+    transport_type = mosaic.LocalTransport
+
+    def setUp(self):
+        self.transport = self.transport_type(mosaic.LOCAL_SERIAL)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def run_lines(self, cmd):
+        return list(self.transport.run(cmd))
+
+    def test_output(self):
+        self.assertEqual(self.run_lines('echo a; echo; echo b'), [ 'a', '', 'b' ])
+        self.assertEqual(self.run_lines('true'), [])
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(self.run_lines('printf "a\\nb"'), [ 'a', 'b' ])
+        self.assertEqual(self.run_lines('echo next'), [ 'next' ])
+
+    def test_status(self):
+        with self.assertRaises(mosaic.MosaicError) as context:
+            self.run_lines('echo failed; sh -c "exit 3"')
+        self.assertIn('failed', str(context.exception))
+        with self.assertRaises(mosaic.MosaicError) as context:
+            self.run_lines('sh -c "exit 3"')
+        self.assertIn('status 3', str(context.exception))
+        self.assertEqual(self.run_lines('echo next'), [ 'next' ])
+
+    def test_drain(self):
+        lines = self.transport.run('echo a; echo b; echo c')
+        self.assertEqual(next(lines), 'a')
+        self.assertEqual(self.run_lines('echo next'), [ 'next' ])
+        self.assertEqual(self.run_lines('printf partial'), [ 'partial' ])
+
+
+class EchoingShellTransportTest(ShellTransportTest):
+
+    transport_type = EchoingTransport
+
+    def test_echoed_command(self):
+        self.assertEqual(self.run_lines('echo hello'), [ 'hello' ])
+        self.assertEqual(self.run_lines('echo "echo hello"'), [ 'echo hello' ])
+
+
+if __name__ == '__main__':
+    unittest.main()